@@ -2,12 +2,11 @@
 
 import argparse
 import csv
-import json
 import sqlite3
-from itertools import zip_longest
 from statistics import NormalDist
 
 import numpy as np
+from score_matrix import load_score_matrix
 
 
 def main():
@@ -17,32 +16,24 @@ def main():
     args = parser.parse_args()
 
     con = sqlite3.connect(args.root_dir.rstrip('/') + '.db')
-    cur = con.execute('''
-        SELECT domain, job_hash, form_filename, scores FROM form_classification
-        WHERE job_hash NOT IN (SELECT job_hash FROM form_classification_gpt)
-    ''')
+    descriptors, _, scores = load_score_matrix(
+        con, 'job_hash NOT IN (SELECT job_hash FROM form_classification_gpt)')
+    con.close()
 
     N_BINS = 20
 
-    descriptors = []
-    sample_score = []
-
-    for domain, job_hash, form_filename, scores_json in cur:
-        scores = json.loads(scores_json)
-        descriptors.append((domain, job_hash, form_filename))
-        sample_score.append(min(scores.values(), key=lambda v: abs(v - 0.5)))
-        # sample_score.append(scores['Content Submission Form'])
+    # Score of each form closest to the decision boundary
+    sample_score = scores[np.arange(len(scores)), np.abs(scores - 0.5).argmin(axis=1)]
 
     bin_edges = np.linspace(0.0, 1.0, N_BINS, endpoint=False)
     bin_indices = np.digitize(sample_score, bin_edges)
     bin_counts = np.bincount(bin_indices, minlength=N_BINS + 1)
-    bin_weights = np.zeros(N_BINS + 1)
+
     norm = NormalDist(mu=0.5, sigma=0.15)
+    bin_cdf = np.diff([norm.cdf(x) for x in [*bin_edges, 1.0]])
 
-    for i, (left, right) in enumerate(zip_longest(bin_edges, bin_edges[1:], fillvalue=1.0)):
-        cdf = norm.cdf(right) - norm.cdf(left)
-        sample_weight = cdf / bin_counts[i + 1]
-        bin_weights[i + 1] = sample_weight
+    bin_weights = np.zeros(N_BINS + 1)
+    bin_weights[1:] = bin_cdf / bin_counts[1:]
 
     sample_weights = bin_weights[bin_indices]
 
@@ -50,10 +41,8 @@ def main():
         writer = csv.writer(fout)
         writer.writerow(["domain", "job_hash", "form_filename", "sample_score", "weight"])
 
-        for i, desc in enumerate(descriptors):
-            writer.writerow([*desc, sample_score[i], sample_weights[i]])
-
-    con.close()
+        writer.writerows([*desc, score, weight]
+                         for desc, score, weight in zip(descriptors, sample_score.tolist(), sample_weights.tolist()))
 
 
 if __name__ == "__main__":
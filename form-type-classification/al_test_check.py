@@ -8,8 +8,8 @@ import csv
 
 import numpy as np
 from datasets import Dataset
-from sklearn.metrics import accuracy_score, classification_report
-from utils import LABELS, load_html_string
+from score_matrix import load_score_matrix
+from utils import LABELS, compute_classification_metrics, load_html_strings
 
 
 def main():
@@ -38,52 +38,21 @@ def main():
     ).filter(lambda e: (e['domain'], e['job_hash'], e['form_filename']) in test_descs)
 
     ds_form = ds_form_descriptors.map(
-        load_html_string,
+        load_html_strings,
+        batched=True,
         fn_kwargs={'root_dir': args.root_dir},
         num_proc=args.nproc,
         keep_in_memory=True,
     ).filter(lambda e: e['label'] is not None)
 
     # Add predictions to the dataset
-    cur = con.execute('SELECT domain, job_hash, form_filename, scores FROM form_classification')
-    all_proba = {}
-
-    for domain, job_hash, form_filename, scores_json in cur:
-        if (domain, job_hash, form_filename) in test_descs:
-            scores_dict = json.loads(scores_json)
-            all_proba[domain, job_hash, form_filename] = [scores_dict[label] for label in LABELS]
-
+    descriptors, _, scores = load_score_matrix(con, labels=LABELS)
     con.close()
 
-    def add_proba(example):
-        domain = example['domain']
-        job_hash = example['job_hash']
-        form_filename = example['form_filename']
-        return {'proba': all_proba[domain, job_hash, form_filename]}
-
-    ds = ds_form.map(add_proba)
-
-    labels = np.array(ds['label'])
-    proba = np.array(ds['proba'])
-
-    hard_labels = np.int32(labels >= 0.5)
-    hard_predicts = np.int32(proba >= 0.5)
-
-    cls_report = classification_report(
-        hard_labels,
-        hard_predicts,
-        target_names=LABELS,
-        output_dict=True,
-        zero_division=np.nan,
-    )
-
-    metrics = {
-        'accuracy': accuracy_score(hard_labels, hard_predicts),
-    }
+    row_index = {desc: i for i, desc in enumerate(descriptors)}
+    proba = scores[[row_index[desc] for desc in zip(ds_form['domain'], ds_form['job_hash'], ds_form['form_filename'])]]
 
-    for key1, d1 in cls_report.items():
-        for key2, value in d1.items():
-            metrics[f'{key1}/{key2}'] = value
+    metrics = compute_classification_metrics(np.array(ds_form['label']), proba)
 
     print(metrics)
 
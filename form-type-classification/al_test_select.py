@@ -2,8 +2,15 @@
 
 import argparse
 import csv
+import os
 import sqlite3
-from collections import defaultdict
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(sys.path[0], '..', 'pylib'))
+# pylint: disable=wrong-import-position
+from samplingutil import stratified_sample
 
 
 def main():
@@ -12,30 +19,26 @@ def main():
     parser.add_argument("output", help="CSV file to write the results to")
     parser.add_argument("--target", type=int, default=20,
                         help="How many samples for each form type")
+    parser.add_argument("--seed", type=int, help="Random seed")
     args = parser.parse_args()
 
     con = sqlite3.connect(args.root_dir.rstrip('/') + '.db')
     cur = con.execute('''
         SELECT domain, job_hash, form_filename, form_type FROM form_classification
         WHERE job_hash NOT IN (SELECT job_hash FROM form_classification_gpt)
-        ORDER BY RANDOM()
     ''')
 
-    form_selection = defaultdict(list)
-
-    for domain, job_hash, form_filename, form_type in cur:
-        if len(form_selection[form_type]) < args.target:
-            form_selection[form_type].append((domain, job_hash, form_filename))
+    all_forms = cur.fetchall()
+    form_types = [row[3] for row in all_forms]
+    selected_idx = stratified_sample(form_types, args.target, np.random.default_rng(args.seed))
 
     with open(args.output, "w", encoding='utf-8', newline="") as fout:
         writer = csv.writer(fout)
         writer.writerow(["domain", "job_hash", "form_filename", "weight"])
+        writer.writerows((*all_forms[i][:3], 1.0) for i in selected_idx)
 
-        for form_type, forms in sorted(form_selection.items()):
-            print(form_type, len(forms))
-
-            for domain, job_hash, form_filename in forms:
-                writer.writerow([domain, job_hash, form_filename, 1.0])
+    for form_type, count in zip(*np.unique(np.array(form_types)[selected_idx], return_counts=True)):
+        print(form_type, count)
 
     con.close()
 
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import platform
+import re
+import sqlite3
+import time
+import warnings
+from contextlib import nullcontext
+
+warnings.filterwarnings('ignore', module='transformers.utils')
+
+# pylint: disable=wrong-import-position
+import torch
+from datasets import Dataset
+from torch.utils.data import DataLoader
+from transformers import MarkupLMForSequenceClassification, MarkupLMProcessor, MarkupLMTokenizerFast
+from utils import MyMarkupLMFeatureExtractor, TokenBudgetBatchSampler, load_html_strings
+
+
+def run_loader(model, dataloader, device_str, bf16):
+    n_forms = 0
+    n_batches = 0
+
+    if device_str.startswith('cuda'):
+        torch.cuda.synchronize()
+
+    t0 = time.perf_counter()
+
+    with (torch.no_grad(),
+          torch.autocast(device_type=device_str.split(':')[0], dtype=torch.bfloat16) if bf16 else nullcontext()):
+        for batch in dataloader:
+            output, = model(**{k: v.to(model.device) for k, v in batch.items()}, return_dict=False)
+            output.sigmoid_().tolist()
+
+            n_forms += len(output)
+            n_batches += 1
+
+    if device_str.startswith('cuda'):
+        torch.cuda.synchronize()
+
+    return n_forms, n_batches, time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare fixed-size and token-budget batching in classify.py")
+    parser.add_argument("model_dir", help="Path to the model directory")
+    parser.add_argument("root_dir", help="Root directory of the dataset")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu", help="Torch device")
+    parser.add_argument("--limit", type=int, default=5000, help="Number of forms to benchmark")
+    parser.add_argument("--batch-size", type=int, default=128, help="Batch size of the fixed-size loader")
+    parser.add_argument("--max-tokens", type=int, default=65536, help="Token budget of the token-budget loader")
+    parser.add_argument("--nproc", type=int, default=min(os.cpu_count(), 32), help="Number of processes")
+    parser.add_argument("--bf16", action="store_true", help="Use bfloat16")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.root_dir.rstrip('/') + '.db')
+    con.create_function("REGEXP", 2, lambda pattern, text: 1 if re.search(pattern, text) else 0)
+
+    ds_form = Dataset.from_sql(r'''
+        SELECT domain, job_hash, form_filename
+            FROM field_classification
+            WHERE field_list REGEXP
+                '"(Address|EmailAddress|GovernmentId|BankAccountNumber|PersonName|PhoneNumber|UsernameOrOtherId|TaxId)"'
+            ORDER BY RANDOM()
+            LIMIT :limit
+    ''', con, params={'limit': args.limit}, keep_in_memory=True)
+    con.close()
+
+    ds_form = ds_form.map(
+        load_html_strings,
+        batched=True,
+        fn_kwargs={'root_dir': args.root_dir},
+        num_proc=args.nproc,
+        keep_in_memory=True,
+    ).select_columns(['html_strings'])
+
+    feature_extractor = MyMarkupLMFeatureExtractor()
+    tokenizer = MarkupLMTokenizerFast.from_pretrained("microsoft/markuplm-large")
+    processor = MarkupLMProcessor(feature_extractor, tokenizer)
+
+    model = MarkupLMForSequenceClassification.from_pretrained(args.model_dir, device_map=args.device)
+    model.eval()
+
+    loader_kwargs = {
+        'pin_memory': True,
+        'num_workers': args.nproc,
+        'multiprocessing_context': 'fork' if platform.system() == 'Darwin' else None,
+    }
+
+    # Previous loader: fixed batch size, feature extraction and padding in collate_fn
+    def fixed_collate_fn(examples):
+        html_strings = [e['html_strings'] for e in examples]
+        return processor(html_strings, truncation=True, padding=True, return_tensors='pt')
+
+    fixed_loader = DataLoader(ds_form, batch_size=args.batch_size, collate_fn=fixed_collate_fn, **loader_kwargs)
+
+    # Current loader: features extracted once, batches packed by token length
+    t0 = time.perf_counter()
+    ds_features = ds_form.map(
+        lambda e: processor(e['html_strings'], truncation=True),
+        batched=True,
+        num_proc=args.nproc,
+        remove_columns=['html_strings'],
+        keep_in_memory=True,
+    )
+    preprocess_time = time.perf_counter() - t0
+
+    lengths = [len(i) for i in ds_features['input_ids']]
+    batch_sampler = TokenBudgetBatchSampler(lengths, args.max_tokens)
+    budget_loader = DataLoader(
+        ds_features,
+        batch_sampler=batch_sampler,
+        collate_fn=lambda examples: tokenizer.pad(examples, padding=True, return_tensors='pt'),
+        **loader_kwargs,
+    )
+
+    print(f"Device: {args.device}, forms: {len(ds_form)}, mean length: {sum(lengths) / len(lengths):.1f} tokens")
+
+    for name, dataloader, extra_time in [
+        (f'fixed (batch size {args.batch_size})', fixed_loader, 0.0),
+        (f'token budget ({args.max_tokens} tokens)', budget_loader, preprocess_time),
+    ]:
+        n_forms, n_batches, elapsed = run_loader(model, dataloader, args.device, args.bf16)
+        elapsed += extra_time
+        print(f"{name}: {n_batches} batches, {elapsed:.1f}s, {n_forms / elapsed:.1f} forms/s")
+
+
+if __name__ == "__main__":
+    main()
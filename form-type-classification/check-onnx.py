@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import json
+import os
+import sqlite3
+import time
+import warnings
+
+warnings.filterwarnings('ignore', module='transformers.utils')
+
+# pylint: disable=wrong-import-position
+import numpy as np
+import torch
+from datasets import Dataset
+from feature_cache import CachedFeatureDataset, MarkupLMFeatureCache
+from onnx_backend import OnnxMarkupLMForSequenceClassification
+from torch.utils.data import DataLoader
+from transformers import MarkupLMForSequenceClassification, MarkupLMProcessor, MarkupLMTokenizerFast
+from utils import (LABELS, MyMarkupLMFeatureExtractor, TokenBudgetBatchSampler, compute_classification_metrics,
+                   load_html_strings)
+
+
+def predict_proba(model, dataloader, n_examples):
+    """Return probabilities in dataset order and the throughput in forms/s."""
+    label_order = [model.config.label2id[label] for label in LABELS]
+    proba = np.zeros((n_examples, len(LABELS)), dtype=np.float32)
+
+    t0 = time.perf_counter()
+
+    with torch.no_grad():
+        for indices, batch in dataloader:
+            output, = model(**{k: v.to(model.device) for k, v in batch.items()}, return_dict=False)
+            proba[indices] = output.sigmoid().float().numpy()[:, label_order]
+
+    return proba, n_examples / (time.perf_counter() - t0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check accuracy parity and speed of the ONNX form classifier")
+    parser.add_argument("model_dir", help="Path to the PyTorch model directory")
+    parser.add_argument("onnx_dir", help="Path to the exported ONNX model directory")
+    parser.add_argument("root_dir", help="Root directory of the dataset")
+    parser.add_argument("--test-csv",
+                        help="Only use GPT-labeled samples in this CSV list (e.g., from al_test_select.py)")
+    parser.add_argument("--max-tokens", type=int, default=16384, help="Token budget per batch")
+    parser.add_argument("--nproc", type=int, default=min(os.cpu_count(), 32), help="Number of processes")
+    parser.add_argument("--feature-cache-dir",
+                        help="Directory for cached MarkupLM inputs (default: <root_dir>.markuplm_features)")
+    parser.add_argument('--output', '-o', type=str, help="JSON output file")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.root_dir.rstrip('/') + '.db')
+    ds_form = Dataset.from_sql('''
+        SELECT domain, job_hash, form_filename, annotations FROM form_classification_gpt
+    ''', con, keep_in_memory=True)
+    con.close()
+
+    if args.test_csv:
+        with open(args.test_csv, "r", encoding='utf-8', newline="") as fin:
+            test_descs = {(row['domain'], row['job_hash'], row['form_filename']) for row in csv.DictReader(fin)}
+
+        ds_form = ds_form.filter(lambda e: (e['domain'], e['job_hash'], e['form_filename']) in test_descs)
+
+    ds_form = ds_form.map(
+        load_html_strings,
+        batched=True,
+        fn_kwargs={'root_dir': args.root_dir},
+        num_proc=args.nproc,
+        keep_in_memory=True,
+    ).filter(lambda e: e['label'] is not None)
+
+    feature_extractor = MyMarkupLMFeatureExtractor()
+    tokenizer = MarkupLMTokenizerFast.from_pretrained("microsoft/markuplm-large")
+    processor = MarkupLMProcessor(feature_extractor, tokenizer)
+
+    feature_cache = MarkupLMFeatureCache(args.feature_cache_dir or args.root_dir.rstrip('/') + '.markuplm_features',
+                                         tokenizer)
+    feature_cache.update(ds_form, processor, args.nproc)
+
+    labels = np.array(ds_form['label'])
+    ds_features = CachedFeatureDataset(feature_cache, ds_form['html_hash'])
+
+    def collate_fn(indices):
+        return indices, feature_cache.collate([ds_features[i] for i in indices])
+
+    batch_sampler = TokenBudgetBatchSampler(ds_features.lengths(), args.max_tokens)
+    dataloader = DataLoader(range(len(ds_features)), batch_sampler=batch_sampler, collate_fn=collate_fn)
+
+    # Compare both backends on CPU with the same thread budget
+    torch_model = MarkupLMForSequenceClassification.from_pretrained(args.model_dir, device_map='cpu')
+    torch_model.eval()
+    onnx_model = OnnxMarkupLMForSequenceClassification(args.onnx_dir, n_threads=torch.get_num_threads())
+
+    torch_proba, torch_speed = predict_proba(torch_model, dataloader, len(ds_features))
+    onnx_proba, onnx_speed = predict_proba(onnx_model, dataloader, len(ds_features))
+
+    report = {
+        'n_samples': len(ds_features),
+        'max_abs_diff': float(np.abs(torch_proba - onnx_proba).max()),
+        'prediction_agreement': float(((torch_proba >= 0.5) == (onnx_proba >= 0.5)).all(1).mean()),
+        'torch/forms_per_second': torch_speed,
+        'onnx/forms_per_second': onnx_speed,
+    }
+
+    for name, proba in ('torch', torch_proba), ('onnx', onnx_proba):
+        for key, value in compute_classification_metrics(labels, proba).items():
+            report[f'{name}/{key}'] = value
+
+    for key in 'n_samples', 'max_abs_diff', 'prediction_agreement':
+        print(f'{key}: {report[key]}')
+
+    for key in 'forms_per_second', 'accuracy', 'macro avg/f1-score':
+        print(f"{key}: torch={report[f'torch/{key}']:.4f} onnx={report[f'onnx/{key}']:.4f}")
+
+    if args.output:
+        with open(args.output, "w", encoding='utf-8') as fout:
+            json.dump(report, fout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
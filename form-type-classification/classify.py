@@ -6,8 +6,10 @@ import os
 import platform
 import re
 import sqlite3
+import time
 import warnings
 from contextlib import nullcontext
+from pathlib import Path
 
 warnings.filterwarnings('ignore', module='transformers.utils')
 
@@ -15,18 +17,140 @@ warnings.filterwarnings('ignore', module='transformers.utils')
 import torch
 import tqdm
 from datasets import Dataset
-from torch.utils.data import DataLoader, default_collate
-from transformers import MarkupLMForSequenceClassification, MarkupLMProcessor, MarkupLMTokenizerFast
-from utils import MyMarkupLMFeatureExtractor, load_html_string
+from feature_cache import CachedFeatureDataset, MarkupLMFeatureCache
+from score_matrix import create_score_labels_table, encode_scores
+from torch.utils.data import DataLoader
+from transformers import AutoConfig, MarkupLMForSequenceClassification, MarkupLMProcessor, MarkupLMTokenizerFast
+from utils import MyMarkupLMFeatureExtractor, TokenBudgetBatchSampler, load_html_strings
+
+
+def get_default_device():
+    if torch.cuda.is_available():
+        return "cuda"
+
+    if torch.backends.mps.is_available():
+        return "mps"
+
+    warnings.warn("No accelerator available", UserWarning)
+    return "cpu"
+
+
+def get_model_id(model_dir):
+    """Identify a model checkpoint so that shard checkpoints of another model are not reused."""
+    config_path = os.path.join(model_dir, 'config.json')
+    return f'{os.path.realpath(model_dir)}@{os.stat(config_path).st_mtime_ns}'
+
+
+def load_checkpoints(checkpoint_dir: Path, model_id: str) -> dict[str, tuple[str, str]]:
+    """Read completed results (html_hash -> (form_type, scores_json)) from all shard checkpoints."""
+    results = {}
+
+    for path in sorted(checkpoint_dir.glob('shard-*.db')):
+        ckpt_con = sqlite3.connect(path)
+
+        try:
+            row = ckpt_con.execute("SELECT value FROM checkpoint_info WHERE key = 'model_id'").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+
+        if row is None or row[0] != model_id:
+            ckpt_con.close()
+            warnings.warn(f"Removing checkpoint {path} of a different model", UserWarning)
+            path.unlink()
+            continue
+
+        for html_hash, form_type, scores_json in ckpt_con.execute('SELECT * FROM checkpoint_results'):
+            results[html_hash] = (form_type, scores_json)
+
+        ckpt_con.close()
+
+    return results
+
+
+def classify_shard(shard_idx, device_str, html_hashes, feature_cache, checkpoint_path, model_id, args):
+    """Run inference over one shard of unique forms, checkpointing every batch."""
+    devices = args.devices or [device_str]
+
+    if device_str == 'cpu':
+        torch.set_num_threads(max(1, os.cpu_count() // devices.count('cpu')))
+
+    if args.backend == 'onnx':
+        from onnx_backend import OnnxMarkupLMForSequenceClassification  # pylint: disable=import-outside-toplevel
+        model = OnnxMarkupLMForSequenceClassification(args.model_dir, n_threads=torch.get_num_threads())
+    else:
+        model = MarkupLMForSequenceClassification.from_pretrained(args.model_dir, device_map=device_str)
+
+    model.eval()
+
+    ds_shard = CachedFeatureDataset(feature_cache, html_hashes)
+    batch_sampler = TokenBudgetBatchSampler(ds_shard.lengths(), args.max_tokens, args.batch_size)
+
+    def collate_fn(indices):
+        return [html_hashes[i] for i in indices], feature_cache.collate([ds_shard[i] for i in indices])
+
+    dataloader = DataLoader(
+        range(len(ds_shard)),
+        batch_sampler=batch_sampler,
+        collate_fn=collate_fn,
+        pin_memory=True,
+        num_workers=max(1, args.nproc // len(devices)),
+        multiprocessing_context='fork' if platform.system() == 'Darwin' else None,
+    )
+
+    ckpt_con = sqlite3.connect(checkpoint_path)
+    ckpt_con.execute('CREATE TABLE IF NOT EXISTS checkpoint_info (key TEXT PRIMARY KEY, value TEXT) STRICT')
+    ckpt_con.execute('''CREATE TABLE IF NOT EXISTS checkpoint_results (
+        html_hash TEXT PRIMARY KEY,
+        form_type TEXT NOT NULL,
+        scores TEXT NOT NULL
+    ) STRICT''')
+    ckpt_con.execute("INSERT OR REPLACE INTO checkpoint_info VALUES ('model_id', ?)", (model_id,))
+    ckpt_con.commit()
+
+    with (tqdm.tqdm(total=len(ds_shard), smoothing=0.1, position=shard_idx, desc=f'Shard {shard_idx}') as pbar,
+          torch.no_grad(),
+          torch.autocast(device_type=device_str.split(':')[0], dtype=torch.bfloat16)
+          if args.bf16 and args.backend == 'torch' else nullcontext()):
+        for batch_hashes, batch in dataloader:
+            output, = model(**{k: v.to(model.device) for k, v in batch.items()}, return_dict=False)
+            output.sigmoid_()
+            output_list = output.tolist()
+
+            ckpt_rows = []
+
+            for html_hash, scores in zip(batch_hashes, output_list):
+                dict_scores = {model.config.id2label[i]: score for i, score in enumerate(scores)}
+
+                form_type = max(dict_scores, key=dict_scores.get)
+                if dict_scores[form_type] < 0.5:
+                    form_type = 'Unknown'
+
+                ckpt_rows.append((html_hash, form_type, json.dumps(dict_scores, separators=(',', ':'))))
+
+            ckpt_con.executemany('INSERT OR REPLACE INTO checkpoint_results VALUES (?, ?, ?)', ckpt_rows)
+            ckpt_con.commit()
+            pbar.update(len(ckpt_rows))
+
+    ckpt_con.close()
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("model_dir", help="Path to the model directory")
     parser.add_argument("root_dir", help="Root directory of the dataset")
-    parser.add_argument("--batch-size", type=int, default=128, help="Batch size")
+    parser.add_argument("--max-tokens", type=int, default=65536,
+                        help="Token budget per batch (padded length x number of forms)")
+    parser.add_argument("--batch-size", type=int, default=512, help="Maximum number of forms per batch")
     parser.add_argument("--nproc", type=int, default=min(os.cpu_count(), 32), help="Number of processes")
     parser.add_argument("--bf16", action="store_true", help="Use bfloat16")
+    parser.add_argument("--backend", choices=["torch", "onnx"], default="torch",
+                        help="Inference backend (onnx: a model directory exported by export-onnx.py, CPU only)")
+    parser.add_argument("--devices", nargs='+',
+                        help="Run one shard per device in its own process (e.g., cuda:0 cuda:1, or cpu cpu cpu)")
+    parser.add_argument("--checkpoint-dir",
+                        help="Directory for shard checkpoints (default: <root_dir>.form_classification)")
+    parser.add_argument("--feature-cache-dir",
+                        help="Directory for cached MarkupLM inputs (default: <root_dir>.markuplm_features)")
     args = parser.parse_args()
 
     con = sqlite3.connect(args.root_dir.rstrip('/') + '.db')
@@ -37,62 +161,98 @@ def main():
             FROM field_classification
             WHERE field_list REGEXP
                 '"(Address|EmailAddress|GovernmentId|BankAccountNumber|PersonName|PhoneNumber|UsernameOrOtherId|TaxId)"'
+            ORDER BY domain, job_hash
     ''', con, keep_in_memory=True)
 
+    t0 = time.perf_counter()
     ds_form = ds_form.map(
-        load_html_string,
+        load_html_strings,
+        batched=True,
         fn_kwargs={'root_dir': args.root_dir},
         num_proc=args.nproc,
         keep_in_memory=True,
     )
+    print(f"Loaded {len(ds_form)} forms in {time.perf_counter() - t0:.1f}s")
+
+    # Deduplicate HTML strings: map each content digest to a group of identical forms
+    group_index: dict[str, int] = {}
+    group_members: list[list[int]] = []
 
-    # Deduplicate HTML strings
-    ds_form = ds_form.sort("html_strings")
-    last_html_string = None
-    selected_indices = []
+    for row_idx, html_hash in enumerate(ds_form['html_hash']):
+        group_id = group_index.setdefault(html_hash, len(group_index))
 
-    for idx, example in enumerate(ds_form):
-        if example['html_strings'] != last_html_string:
-            last_html_string = example['html_strings']
-            selected_indices.append(idx)
+        if group_id == len(group_members):
+            group_members.append([])
 
-    ds_deduplicated = ds_form.select(selected_indices).select_columns(['html_strings'])
+        group_members[group_id].append(row_idx)
 
-    # Process the HTML strings into MarkupLM model inputs
+    descriptors = list(zip(ds_form['domain'], ds_form['job_hash'], ds_form['form_filename']))
+
+    # Skip unique forms already classified by a previous (possibly interrupted) run
+    checkpoint_dir = Path(args.checkpoint_dir or args.root_dir.rstrip('/') + '.form_classification')
+    checkpoint_dir.mkdir(exist_ok=True)
+    model_id = get_model_id(args.model_dir)
+    results = load_checkpoints(checkpoint_dir, model_id)
+
+    todo_rows = [members[0] for html_hash, members in zip(group_index, group_members) if html_hash not in results]
+    print(f"Unique forms: {len(group_members)}, already classified: {len(group_members) - len(todo_rows)}")
+
+    ds_todo = ds_form.select(todo_rows).select_columns(['html_strings', 'html_hash'])
+
+    # Process the HTML strings into MarkupLM model inputs, reusing cached ones
     feature_extractor = MyMarkupLMFeatureExtractor()
     tokenizer = MarkupLMTokenizerFast.from_pretrained("microsoft/markuplm-large")
     processor = MarkupLMProcessor(feature_extractor, tokenizer)
 
-    def collate_fn(examples):
-        html_strings = [e['html_strings'] for e in examples]
-        processed = processor(html_strings, truncation=True, padding=True, return_tensors='pt')
+    feature_cache = MarkupLMFeatureCache(args.feature_cache_dir or args.root_dir.rstrip('/') + '.markuplm_features',
+                                         tokenizer)
+    feature_cache.update(ds_todo, processor, args.nproc)
 
-        batch = default_collate(examples)
-        batch.update(processed)
+    # Split unique forms into shards by content digest, so the assignment is stable across runs
+    devices = args.devices or ['cpu' if args.backend == 'onnx' else get_default_device()]
 
-        return batch
+    if args.backend == 'onnx' and any(d != 'cpu' for d in devices):
+        parser.error("The onnx backend only supports cpu devices")
 
-    if torch.cuda.is_available():
-        device_str = "cuda"
-    elif torch.backends.mps.is_available():
-        device_str = "mps"
+    n_shards = len(devices)
+    shard_hashes: list[list[str]] = [[] for _ in range(n_shards)]
+
+    for html_hash in ds_todo['html_hash']:
+        shard_hashes[int(html_hash[:8], 16) % n_shards].append(html_hash)
+
+    shard_jobs = []
+
+    for shard_idx, (device_str, html_hashes) in enumerate(zip(devices, shard_hashes)):
+        if html_hashes:
+            checkpoint_path = checkpoint_dir / f'shard-{shard_idx}-of-{n_shards}.db'
+            shard_jobs.append((shard_idx, device_str, html_hashes, feature_cache, checkpoint_path, model_id, args))
+
+    if n_shards == 1:
+        for job in shard_jobs:
+            classify_shard(*job)
     else:
-        device_str = "cpu"
-        warnings.warn("No accelerator available", UserWarning)
+        mp_context = torch.multiprocessing.get_context('spawn')
+        processes = [mp_context.Process(target=classify_shard, args=job) for job in shard_jobs]
 
-    model = MarkupLMForSequenceClassification.from_pretrained(args.model_dir, device_map=device_str)
-    model.eval()
+        for p in processes:
+            p.start()
 
-    dataloader = DataLoader(
-        ds_deduplicated,
-        batch_size=args.batch_size,
-        collate_fn=collate_fn,
-        pin_memory=True,
-        num_workers=args.nproc,
-        shuffle=False,
-        multiprocessing_context='fork' if platform.system() == 'Darwin' else None,
-    )
+        for p in processes:
+            p.join()
 
+        if failed := [job[0] for job, p in zip(shard_jobs, processes) if p.exitcode != 0]:
+            raise RuntimeError(f"Shards {failed} failed; re-run to resume from checkpoints")
+
+    # Merge shard checkpoints and fan the results out to all forms
+    results = load_checkpoints(checkpoint_dir, model_id)
+
+    # Float32 score vectors, in the label order of the model config, for fast bulk loading
+    config = AutoConfig.from_pretrained(args.model_dir)
+    labels = [config.id2label[i] for i in range(config.num_labels)]
+    score_blobs = {html_hash: encode_scores(json.loads(scores_json), labels)
+                   for html_hash, (_, scores_json) in results.items()}
+
+    create_score_labels_table(con, labels)
     con.execute('DROP TABLE IF EXISTS form_classification')
     con.execute('''CREATE TABLE form_classification (
         domain TEXT NOT NULL,
@@ -100,45 +260,16 @@ def main():
         form_filename TEXT NOT NULL,
         form_type TEXT NOT NULL,
         scores TEXT NOT NULL,
+        scores_f32 BLOB NOT NULL,
         UNIQUE(job_hash, form_filename)
     ) STRICT''')
 
-    # Main inference loop
-    with (tqdm.tqdm(total=len(ds_form), smoothing=0.1) as pbar,
-          torch.no_grad(),
-          torch.autocast(device_type=device_str, dtype=torch.bfloat16) if args.bf16 else nullcontext()):
-        ds_idx = 0
-
-        for batch in dataloader:
-            html_strings = batch.pop('html_strings')
-
-            output, = model(**{k: v.to(model.device) for k, v in batch.items()}, return_dict=False)
-            output.sigmoid_()
-            output_list = output.tolist()
-
-            for html_string, scores in zip(html_strings, output_list):
-                dict_scores = {model.config.id2label[i]: score for i, score in enumerate(scores)}
-
-                form_type = max(dict_scores, key=dict_scores.get)
-                if dict_scores[form_type] < 0.5:
-                    form_type = 'Unknown'
-
-                scores_json = json.dumps(dict_scores, separators=(',', ':'))
-
-                db_rows = []
-
-                while ds_idx < len(ds_form) and ds_form[ds_idx]['html_strings'] == html_string:
-                    desc = [ds_form[ds_idx][k] for k in ('domain', 'job_hash', 'form_filename')]
-                    db_rows.append([*desc, form_type, scores_json])
-                    ds_idx += 1
-
-                assert len(db_rows) > 0
-                con.executemany('INSERT INTO form_classification VALUES (?, ?, ?, ?, ?)', db_rows)
-                con.commit()
-                pbar.update(len(db_rows))
-
-        assert ds_idx == len(ds_form)
-
+    con.executemany('INSERT INTO form_classification VALUES (?, ?, ?, ?, ?, ?)', (
+        (*descriptors[row_idx], *results[html_hash], score_blobs[html_hash])
+        for html_hash, members in zip(group_index, group_members)
+        for row_idx in members
+    ))
+    con.commit()
     con.close()
 
 
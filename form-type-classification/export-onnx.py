@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import warnings
+
+warnings.filterwarnings('ignore', module='transformers.utils')
+
+# pylint: disable=wrong-import-position
+import torch
+from onnx_backend import ONNX_INPUT_NAMES, ONNX_MODEL_FILENAME, MarkupLMLogitsWrapper
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from transformers import MarkupLMForSequenceClassification, MarkupLMProcessor, MarkupLMTokenizerFast
+from utils import MyMarkupLMFeatureExtractor
+
+SAMPLE_HTML_STRINGS = [
+    '<title>Sign up</title><form><input name="email" placeholder="Email"><input type="submit" value="Join"></form>',
+    '<title>Contact us</title><form><label>Message</label><textarea name="message"></textarea></form>',
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the form type classifier to ONNX")
+    parser.add_argument("model_dir", help="Path to the model directory")
+    parser.add_argument("output_dir", help="Output directory of the ONNX model")
+    parser.add_argument("--quantize", action="store_true", help="Apply dynamic int8 quantization")
+    parser.add_argument("--opset", type=int, default=17, help="ONNX opset version")
+    args = parser.parse_args()
+
+    model = MarkupLMForSequenceClassification.from_pretrained(args.model_dir)
+    model.eval()
+
+    feature_extractor = MyMarkupLMFeatureExtractor()
+    tokenizer = MarkupLMTokenizerFast.from_pretrained("microsoft/markuplm-large")
+    processor = MarkupLMProcessor(feature_extractor, tokenizer)
+    sample_inputs = processor(SAMPLE_HTML_STRINGS, truncation=True, padding=True, return_tensors='pt')
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    output_path = os.path.join(args.output_dir, ONNX_MODEL_FILENAME)
+    export_path = output_path + '.fp32' if args.quantize else output_path
+
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in ONNX_INPUT_NAMES}
+    dynamic_axes['logits'] = {0: 'batch'}
+
+    with torch.no_grad():
+        torch.onnx.export(
+            MarkupLMLogitsWrapper(model),
+            tuple(sample_inputs[name] for name in ONNX_INPUT_NAMES),
+            export_path,
+            input_names=ONNX_INPUT_NAMES,
+            output_names=['logits'],
+            dynamic_axes=dynamic_axes,
+            opset_version=args.opset,
+        )
+
+    if args.quantize:
+        quantize_dynamic(export_path, output_path, weight_type=QuantType.QInt8)
+        os.remove(export_path)
+
+    # Label mapping is read from the config at inference time
+    model.config.save_pretrained(args.output_dir)
+    print("Saved to", output_path)
+
+
+if __name__ == "__main__":
+    main()
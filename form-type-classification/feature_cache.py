@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import sqlite3
+from pathlib import Path
+
+import numpy as np
+import torch
+import transformers
+
+# Bump this whenever MyMarkupLMFeatureExtractor changes the features it produces
+FEATURE_CACHE_VERSION = 1
+
+ARRAY_SPECS = {
+    'input_ids': np.int32,
+    'xpath_tags_seq': np.uint16,
+    'xpath_subs_seq': np.uint16,
+}
+
+
+def get_tokenizer_key(tokenizer):
+    """Digest of everything that determines the processor outputs for a given HTML string."""
+    h = hashlib.blake2s()
+    h.update(json.dumps({
+        'cache_version': FEATURE_CACHE_VERSION,
+        'transformers': transformers.__version__,
+        'vocab': sorted(tokenizer.get_vocab().items()),
+        'tags': sorted(tokenizer.tags_dict.items()),
+        'max_length': tokenizer.model_max_length,
+        'max_depth': tokenizer.max_depth,
+        'max_width': tokenizer.max_width,
+    }).encode())
+    return h.hexdigest()[:16]
+
+
+class MarkupLMFeatureCache:
+    """Persistent cache of MarkupLMProcessor outputs, keyed by form content hash and tokenizer version.
+
+    Token-level arrays of all forms are concatenated into flat files that are memory-mapped on read. An SQLite
+    index maps each content hash to its offset and length (i.e., number of attended tokens). Only one process
+    should call `update()` at a time; any number of processes can read.
+    """
+
+    def __init__(self, cache_dir, tokenizer):
+        self.path = Path(cache_dir) / get_tokenizer_key(tokenizer)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.max_depth = tokenizer.max_depth
+        self.pad_values = {
+            'input_ids': tokenizer.pad_token_id,
+            'xpath_tags_seq': tokenizer.pad_xpath_tags_seq,
+            'xpath_subs_seq': tokenizer.pad_xpath_subs_seq,
+        }
+
+        with self._connect() as con:
+            con.execute('''CREATE TABLE IF NOT EXISTS features (
+                html_hash TEXT PRIMARY KEY,
+                offset INTEGER NOT NULL,
+                length INTEGER NOT NULL
+            ) STRICT''')
+            self.index = {h: (o, l) for h, o, l in con.execute('SELECT html_hash, offset, length FROM features')}
+
+        self._arrays = None
+
+    def __getstate__(self):
+        # Memory maps are reopened in the receiving process
+        return {**self.__dict__, '_arrays': None}
+
+    def _connect(self):
+        return sqlite3.connect(self.path / 'index.db')
+
+    def _array_path(self, name):
+        return self.path / f'{name}.bin'
+
+    def _open_arrays(self):
+        self._arrays = {}
+
+        for name, dtype in ARRAY_SPECS.items():
+            path = self._array_path(name)
+            size = os.path.getsize(path) if path.exists() else 0
+
+            if size == 0:
+                array = np.zeros(0, dtype=dtype)
+            else:
+                array = np.memmap(path, dtype=dtype, mode='r')
+
+            self._arrays[name] = array if name == 'input_ids' else array.reshape(-1, self.max_depth)
+
+    def length(self, html_hash):
+        return self.index[html_hash][1]
+
+    def get(self, html_hash):
+        """Return unpadded model inputs of one form as NumPy arrays."""
+        if self._arrays is None:
+            self._open_arrays()
+
+        offset, length = self.index[html_hash]
+        return {name: array[offset:offset + length] for name, array in self._arrays.items()}
+
+    def update(self, ds, processor, num_proc=None, chunk_size=1024):
+        """Run the processor on forms (`html_strings`, `html_hash` columns) not yet in the cache and store them."""
+        missing_rows = []
+        missing_hashes = set()
+
+        for idx, html_hash in enumerate(ds['html_hash']):
+            if html_hash not in self.index and html_hash not in missing_hashes:
+                missing_hashes.add(html_hash)
+                missing_rows.append(idx)
+
+        if not missing_rows:
+            return
+
+        ds_processed = ds.select(missing_rows).select_columns(['html_strings', 'html_hash']).map(
+            lambda e: processor(e['html_strings'], truncation=True),
+            batched=True,
+            num_proc=num_proc,
+            remove_columns=['html_strings'],
+            keep_in_memory=True,
+        )
+
+        # Drop bytes left by an interrupted update, so that all arrays stay aligned with the index
+        offset = max((o + l for o, l in self.index.values()), default=0)
+
+        for name, dtype in ARRAY_SPECS.items():
+            row_size = np.dtype(dtype).itemsize * (1 if name == 'input_ids' else self.max_depth)
+
+            with open(self._array_path(name), 'ab') as fout:
+                fout.truncate(offset * row_size)
+
+        with self._connect() as con:
+            for batch in ds_processed.iter(batch_size=chunk_size):
+                rows = []
+
+                for html_hash, input_ids in zip(batch['html_hash'], batch['input_ids']):
+                    rows.append((html_hash, offset, len(input_ids)))
+                    offset += len(input_ids)
+
+                # Append arrays before committing the index, so an interrupted update leaves only unused bytes
+                for name, dtype in ARRAY_SPECS.items():
+                    with open(self._array_path(name), 'ab') as fout:
+                        np.concatenate([np.asarray(i, dtype=dtype) for i in batch[name]]).tofile(fout)
+
+                con.executemany('INSERT INTO features VALUES (?, ?, ?)', rows)
+                con.commit()
+
+                self.index.update((h, (o, l)) for h, o, l in rows)
+
+        self._arrays = None
+
+    def collate(self, examples, pad_to_length=None):
+        """Pad cached features (and optional `labels`) of a batch into model input tensors."""
+        max_length = pad_to_length or max(len(e['input_ids']) for e in examples)
+        n = len(examples)
+
+        batch = {}
+
+        for name in ARRAY_SPECS:
+            pad_value = np.asarray(self.pad_values[name], dtype=np.int64)
+            batch[name] = np.empty((n, max_length, *pad_value.shape), dtype=np.int64)
+            batch[name][:] = pad_value
+
+        batch['attention_mask'] = np.zeros((n, max_length), dtype=np.int64)
+        batch['token_type_ids'] = np.zeros((n, max_length), dtype=np.int64)
+
+        for i, e in enumerate(examples):
+            length = len(e['input_ids'])
+
+            for name in ARRAY_SPECS:
+                batch[name][i, :length] = e[name]
+
+            batch['attention_mask'][i, :length] = 1
+
+        batch = {k: torch.from_numpy(v) for k, v in batch.items()}
+
+        if 'labels' in examples[0]:
+            batch['labels'] = torch.tensor([e['labels'] for e in examples], dtype=torch.float32)
+
+        return batch
+
+
+class CachedFeatureDataset(torch.utils.data.Dataset):
+    """Map-style dataset serving cached model inputs, plus optional labels, for a list of content hashes."""
+
+    def __init__(self, cache: MarkupLMFeatureCache, html_hashes, labels=None):
+        self.cache = cache
+        self.html_hashes = list(html_hashes)
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.html_hashes)
+
+    def __getitem__(self, idx):
+        example = self.cache.get(self.html_hashes[idx])
+
+        if self.labels is not None:
+            example['labels'] = self.labels[idx]
+
+        return example
+
+    def lengths(self):
+        return [self.cache.length(h) for h in self.html_hashes]
@@ -0,0 +1,58 @@
+import os
+
+import onnxruntime as ort
+import torch
+from transformers import MarkupLMConfig
+
+ONNX_MODEL_FILENAME = 'model.onnx'
+ONNX_INPUT_NAMES = ['input_ids', 'xpath_tags_seq', 'xpath_subs_seq', 'attention_mask', 'token_type_ids']
+
+
+class MarkupLMLogitsWrapper(torch.nn.Module):
+    """Expose the classifier with positional inputs and a plain logits output for ONNX export."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, xpath_tags_seq, xpath_subs_seq, attention_mask, token_type_ids):
+        logits, = self.model(
+            input_ids=input_ids,
+            xpath_tags_seq=xpath_tags_seq,
+            xpath_subs_seq=xpath_subs_seq,
+            attention_mask=attention_mask,
+            token_type_ids=token_type_ids,
+            return_dict=False,
+        )
+        return logits
+
+
+class OnnxMarkupLMForSequenceClassification:
+    """Drop-in replacement of MarkupLMForSequenceClassification for inference with ONNX Runtime on CPU."""
+
+    def __init__(self, model_dir, n_threads=None):
+        self.config = MarkupLMConfig.from_pretrained(model_dir)
+        self.device = torch.device('cpu')
+
+        session_options = ort.SessionOptions()
+        session_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        if n_threads:
+            session_options.intra_op_num_threads = n_threads
+
+        self.session = ort.InferenceSession(
+            os.path.join(model_dir, ONNX_MODEL_FILENAME),
+            session_options,
+            providers=['CPUExecutionProvider'],
+        )
+
+    def eval(self):
+        return self
+
+    def __call__(self, return_dict=False, **inputs):
+        assert not return_dict
+
+        feeds = {k: inputs[k].numpy() for k in ONNX_INPUT_NAMES}
+        logits, = self.session.run(['logits'], feeds)
+
+        return (torch.from_numpy(logits),)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import json
 import logging
 import os
@@ -10,10 +11,11 @@ import sys
 from pathlib import Path
 
 import tiktoken
-from openai import OpenAI
 
 sys.path.insert(0, os.path.join(sys.path[0], '..', 'pylib'))
-from htmlutil import cleanup_html  # pylint: disable=wrong-import-position
+# pylint: disable=wrong-import-position
+from htmlutil import cleanup_html
+from llmutil import add_engine_arguments, resume_jsonl, run_chat_completions
 
 PROMPT_TEMPLATE = '''
 Analyze the provided HTML code of a web form, along with the URL and title of the web page to determine the type of the form based on its usage.
@@ -48,9 +50,9 @@ def main():
                         help="How many forms to label")
     parser.add_argument("--seed", type=int, default=42, help="Random seed")
     parser.add_argument("--model", default="gpt-4-0125-preview", help="OpenAI model name")
+    add_engine_arguments(parser)
     args = parser.parse_args()
 
-    client = OpenAI()
     tokenizer = tiktoken.encoding_for_model(args.model)
     root_dir = Path(args.root_dir)
 
@@ -69,17 +71,15 @@ def main():
     random.seed(args.seed)
     random.shuffle(all_forms)
 
-    if os.path.exists(args.output_path):
-        with open(args.output_path, encoding='utf-8') as fin:
-            for line in fin:
-                data = json.loads(line)
-                done_forms.add((data['domain'], data['job_hash'], data['form_filename']))
+    for data in resume_jsonl(args.output_path):
+        done_forms.add((data['domain'], data['job_hash'], data['form_filename']))
 
     todo_forms = [i for i in all_forms[:args.target] if i not in done_forms]
     logging.info('Done: %d, todo: %d', len(done_forms), len(todo_forms))
 
-    with open(args.output_path, 'a', encoding='utf-8') as fout:
-        for domain, job_hash, form_filename in todo_forms:
+    def iter_requests():
+        for descriptor in todo_forms:
+            domain, job_hash, form_filename = descriptor
             job_dir = root_dir / domain / job_hash
 
             with open(job_dir / form_filename, encoding='utf-8') as fin:
@@ -90,8 +90,11 @@ def main():
 
             logging.info('Processing %s/%s/%s', domain, job_hash, form_filename)
 
+            if (page_url := next((u for u in reversed(job_data["navigationHistory"]) if u), None)) is None:
+                logging.warning("No page URL in the navigation history")
+                continue
+
             page_title = job_data["pageTitle"].replace('\n', ' ')
-            page_url = next(u for u in reversed(job_data["navigationHistory"]) if u)
             html_code, _ = cleanup_html(form_data["element"]['outerHTML'], tokenizer, target_length=MAX_HTML_TOKENS)
             logging.info('Page title: %r, URL: %s', page_title, page_url)
 
@@ -102,30 +105,40 @@ def main():
                 logging.warning("Prompt length %d exceeds the limit", token_length)
                 continue
 
-            response = client.chat.completions.create(
-                model=args.model,
-                response_format={"type": "json_object"},
-                messages=[
+            yield descriptor, token_length, {
+                'model': args.model,
+                'response_format': {"type": "json_object"},
+                'messages': [
                     {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
                     {"role": "user", "content": prompt}
-                ]
-            )
-
-            response = json.loads(response.choices[0].message.content)
+                ],
+            }
+
+    def save_result(fout, descriptor, response):
+        # Batch results may include forms saved by an earlier ingestion
+        if response is None or descriptor in done_forms:
+            return
+
+        domain, job_hash, form_filename = descriptor
+        response = json.loads(response.choices[0].message.content)
+
+        if isinstance(response, dict) and 'Classification' in response:
+            classification = str(response['Classification']).title()
+        else:
+            logging.warning("Invalid GPT response: %r", response)
+            return
+
+        logging.info('New result: %s/%s/%s -> %s', domain, job_hash, form_filename, classification)
+        print(json.dumps({
+            'domain': domain,
+            'job_hash': job_hash,
+            'form_filename': form_filename,
+            'classification': classification
+        }), file=fout, flush=True)
+        done_forms.add(descriptor)
 
-            if isinstance(response, dict) and 'Classification' in response:
-                classification = str(response['Classification']).title()
-            else:
-                logging.warning("Invalid GPT response: %r", response)
-                continue
-
-            logging.info('New result: %s/%s/%s -> %s', domain, job_hash, form_filename, classification)
-            print(json.dumps({
-                'domain': domain,
-                'job_hash': job_hash,
-                'form_filename': form_filename,
-                'classification': classification
-            }), file=fout)
+    with open(args.output_path, 'a', encoding='utf-8') as fout:
+        run_chat_completions(args, iter_requests, functools.partial(save_result, fout))
 
 
 if __name__ == '__main__':
@@ -15,10 +15,11 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 import tiktoken
-from openai import OpenAI
 
 sys.path.insert(0, os.path.join(sys.path[0], '..', 'pylib'))
-from htmlutil import cleanup_html  # pylint: disable=wrong-import-position
+# pylint: disable=wrong-import-position
+from htmlutil import cleanup_html
+from llmutil import add_engine_arguments, run_chat_completions
 
 PROMPT_TEMPLATE = '''
 Analyze the provided HTML code of a web form, along with the URL and title of the web page to determine the type of the form based on its usage.
@@ -59,6 +60,23 @@ MAX_HTML_TOKENS = 8000
 MAX_PROMPT_TOKENS = 16000
 
 
+def read_form(job_dir, form_filename):
+    with open(job_dir / form_filename, encoding='utf-8') as fin:
+        form_data = json.load(fin)
+
+    with open(job_dir / "job.json", encoding='utf-8') as fin:
+        job_data = json.load(fin)
+
+    page_title = job_data["pageTitle"].replace('\n', ' ')
+    page_url = next(u for u in reversed(job_data["navigationHistory"]) if u)
+    form_html = form_data["element"]['outerHTML']
+
+    html_string = f'<title>{html.escape(page_title)}</title>{form_html}'
+    checksum = hashlib.blake2s(html_string.encode()).hexdigest()
+
+    return page_title, page_url, form_html, checksum
+
+
 def main():
     logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
 
@@ -72,9 +90,9 @@ def main():
     parser.add_argument("--per-domain-limit", type=int, default=10,
                         help="Maximum number of forms to label for each domain")
     parser.add_argument("--model", default="gpt-3.5-turbo-0125", help="OpenAI model name")
+    add_engine_arguments(parser)
     args = parser.parse_args()
 
-    client = OpenAI()
     tokenizer = tiktoken.encoding_for_model(args.model)
     root_dir = Path(args.root_dir)
 
@@ -132,57 +150,75 @@ def main():
         done_hashes.add(form_html_hash)
         domain_counter[domain] += 1
 
-    for descriptor in selected_forms:
-        if descriptor in done_forms:
-            continue
+    pending_checksums = {}
 
-        domain, job_hash, form_filename = descriptor
-        job_dir = root_dir / domain / job_hash
+    def iter_requests():
+        for descriptor in selected_forms:
+            if descriptor in done_forms:
+                continue
 
-        if domain_counter[domain] >= args.per_domain_limit:
-            logging.info('Skip due to domain limit')
-            continue
+            domain, job_hash, form_filename = descriptor
+            job_dir = root_dir / domain / job_hash
 
-        with open(job_dir / form_filename, encoding='utf-8') as fin:
-            form_data = json.load(fin)
+            # Counters include in-flight requests, and are rolled back if a request fails
+            if domain_counter[domain] >= args.per_domain_limit:
+                logging.info('Skip due to domain limit')
+                continue
+
+            logging.info('Processing %s/%s/%s', domain, job_hash, form_filename)
+            page_title, page_url, form_html, checksum = read_form(job_dir, form_filename)
+
+            if checksum in done_hashes:
+                logging.info('Skip due to duplication')
+                continue
 
-        with open(job_dir / "job.json", encoding='utf-8') as fin:
-            job_data = json.load(fin)
+            cleaned_html, _ = cleanup_html(form_html, tokenizer, target_length=MAX_HTML_TOKENS)
+            logging.info('Page title: %r, URL: %s', page_title, page_url)
 
-        logging.info('Processing %s/%s/%s', domain, job_hash, form_filename)
+            prompt = PROMPT_TEMPLATE.format(html_code=cleaned_html, url=page_url, title=page_title)
+            token_length = len(tokenizer.encode(prompt))
 
-        page_title = job_data["pageTitle"].replace('\n', ' ')
-        page_url = next(u for u in reversed(job_data["navigationHistory"]) if u)
-        form_html = form_data["element"]['outerHTML']
+            if token_length > MAX_PROMPT_TOKENS:
+                logging.warning("Prompt length %d exceeds the limit", token_length)
+                continue
 
-        html_string = f'<title>{html.escape(page_title)}</title>{form_html}'
-        checksum = hashlib.blake2s(html_string.encode()).hexdigest()
+            domain_counter[domain] += 1
+            done_hashes.add(checksum)
+            pending_checksums[descriptor] = checksum
+
+            yield descriptor, token_length, {
+                'model': args.model,
+                'response_format': {"type": "json_object"},
+                'seed': args.seed,
+                'n': args.n_tries,
+                'temperature': 0.8,
+                'messages': [
+                    {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
+                    {"role": "user", "content": prompt}
+                ],
+            }
+
+    def save_result(descriptor, full_response):
+        domain, job_hash, form_filename = descriptor
+        checksum = pending_checksums.pop(descriptor, None)
 
-        if checksum in done_hashes:
-            logging.info('Skip due to duplication')
-            continue
+        if full_response is None:
+            if checksum is not None:
+                domain_counter[domain] -= 1
+                done_hashes.discard(checksum)
 
-        cleaned_html, _ = cleanup_html(form_html, tokenizer, target_length=MAX_HTML_TOKENS)
-        logging.info('Page title: %r, URL: %s', page_title, page_url)
+            return
 
-        prompt = PROMPT_TEMPLATE.format(html_code=cleaned_html, url=page_url, title=page_title)
-        token_length = len(tokenizer.encode(prompt))
+        if checksum is None:
+            # Ingesting batch results: requests were prepared by another run
+            *_, checksum = read_form(root_dir / domain / job_hash, form_filename)
 
-        if token_length > MAX_PROMPT_TOKENS:
-            logging.warning("Prompt length %d exceeds the limit", token_length)
-            continue
+            if descriptor in done_forms or checksum in done_hashes:
+                logging.info('Skip due to duplication')
+                return
 
-        full_response = client.chat.completions.create(
-            model=args.model,
-            response_format={"type": "json_object"},
-            seed=args.seed,
-            n=args.n_tries,
-            temperature=0.8,
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
-                {"role": "user", "content": prompt}
-            ]
-        )
+            domain_counter[domain] += 1
+            done_hashes.add(checksum)
 
         annotations = []
 
@@ -200,8 +236,9 @@ def main():
                     (domain, job_hash, form_filename, json.dumps(annotations, separators=(',', ':')), checksum))
         con.commit()
 
-        domain_counter[domain] += 1
-        done_hashes.add(checksum)
+        done_forms.add(descriptor)
+
+    run_chat_completions(args, iter_requests, save_result)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,60 @@
+import json
+import sqlite3
+
+import numpy as np
+
+SCORE_DTYPE = np.float32
+
+
+def create_score_labels_table(con: sqlite3.Connection, labels):
+    """Record the label order of `form_classification.scores_f32` vectors."""
+    con.execute('DROP TABLE IF EXISTS form_classification_labels')
+    con.execute('''CREATE TABLE form_classification_labels (
+        label_idx INTEGER PRIMARY KEY,
+        label TEXT NOT NULL
+    ) STRICT''')
+    con.executemany('INSERT INTO form_classification_labels VALUES (?, ?)', enumerate(labels))
+
+
+def encode_scores(scores: dict[str, float], labels) -> bytes:
+    return np.array([scores[label] for label in labels], dtype=SCORE_DTYPE).tobytes()
+
+
+def load_score_matrix(con: sqlite3.Connection, where='TRUE', params=(), labels=None):
+    """Load classification scores of forms in `form_classification` matching the `where` clause.
+
+    Returns a list of (domain, job_hash, form_filename) descriptors, the label list, and an N x L float32 matrix
+    of scores. If `labels` is given, matrix columns follow that order instead of the stored one.
+    """
+    has_blobs = any(row[1] == 'scores_f32' for row in con.execute('PRAGMA table_info(form_classification)'))
+    score_column = 'scores_f32' if has_blobs else 'scores'
+    cur = con.execute(f'''
+        SELECT domain, job_hash, form_filename, {score_column} FROM form_classification WHERE {where}
+    ''', params)
+
+    if has_blobs:
+        stored_labels = [l for l, in con.execute('SELECT label FROM form_classification_labels ORDER BY label_idx')]
+    else:
+        stored_labels = None
+
+    descriptors = []
+    blobs = []
+
+    for domain, job_hash, form_filename, scores in cur:
+        if not has_blobs:
+            # Tables written by older versions of classify.py only have JSON scores
+            scores_dict = json.loads(scores)
+            stored_labels = stored_labels or list(scores_dict)
+            scores = encode_scores(scores_dict, stored_labels)
+
+        descriptors.append((domain, job_hash, form_filename))
+        blobs.append(scores)
+
+    stored_labels = stored_labels or list(labels or [])
+    matrix = np.frombuffer(b''.join(blobs), dtype=SCORE_DTYPE).reshape(len(blobs), len(stored_labels))
+
+    if labels is not None:
+        matrix = matrix[:, [stored_labels.index(label) for label in labels]]
+        stored_labels = list(labels)
+
+    return descriptors, stored_labels, matrix
@@ -1,16 +1,42 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import os
 import sqlite3
+import time
 
-import numpy as np
+import torch
 from datasets import Dataset
+from feature_cache import CachedFeatureDataset, MarkupLMFeatureCache
 from scipy.special import expit
-from sklearn.metrics import accuracy_score, classification_report
 from transformers import (MarkupLMForSequenceClassification, MarkupLMProcessor, MarkupLMTokenizerFast, Trainer,
-                          TrainingArguments)
-from utils import LABELS, MyMarkupLMFeatureExtractor, load_html_string
+                          TrainerCallback, TrainingArguments)
+from utils import LABELS, MyMarkupLMFeatureExtractor, compute_classification_metrics, load_html_strings
+
+
+class EpochThroughputCallback(TrainerCallback):
+    """Record training throughput (samples/s) and peak GPU memory of each epoch in the log history."""
+
+    def __init__(self, n_samples):
+        self.n_samples = n_samples
+        self.epoch_start_time = None
+
+    def on_epoch_begin(self, args, state, control, **kwargs):
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+
+        self.epoch_start_time = time.perf_counter()
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        elapsed = time.perf_counter() - self.epoch_start_time
+        logs = {'train_epoch_samples_per_second': self.n_samples / elapsed}
+
+        if torch.cuda.is_available():
+            logs['train_epoch_peak_memory_gib'] = torch.cuda.max_memory_allocated() / 2**30
+
+        print(logs)
+        state.log_history.append({**logs, 'epoch': state.epoch, 'step': state.global_step})
 
 
 def main():
@@ -23,6 +49,14 @@ def main():
     parser.add_argument("--base-model", type=str, default="microsoft/markuplm-base", help="Base model")
     parser.add_argument("--epochs", type=int, default=10, help="Number of epochs")
     parser.add_argument("--learning-rate", type=float, default=2e-5, help="Learning rate")
+    parser.add_argument("--feature-cache-dir",
+                        help="Directory for cached MarkupLM inputs (default: <root_dir>.markuplm_features)")
+    parser.add_argument("--pad-to-max-length", action="store_true",
+                        help="Pad every batch to the maximum length instead of the longest sample")
+    parser.add_argument("--group-by-length", action="store_true",
+                        help="Sample training batches of similar lengths to reduce padding")
+    parser.add_argument("--gradient-checkpointing", action="store_true",
+                        help="Trade compute for memory to fit larger batches")
     args = parser.parse_args()
 
     con = sqlite3.connect(args.root_dir.rstrip('/') + '.db')
@@ -32,7 +66,8 @@ def main():
     con.close()
 
     ds_form = ds_form_descriptors.map(
-        load_html_string,
+        load_html_strings,
+        batched=True,
         fn_kwargs={'root_dir': args.root_dir},
         num_proc=args.nproc,
         keep_in_memory=True,
@@ -43,11 +78,13 @@ def main():
     tokenizer = MarkupLMTokenizerFast.from_pretrained(args.base_model)
     processor = MarkupLMProcessor(feature_extractor, tokenizer)
 
-    def preprocess_function(examples):
-        return processor(examples["html_strings"], truncation=True, padding='max_length')
+    feature_cache = MarkupLMFeatureCache(args.feature_cache_dir or args.root_dir.rstrip('/') + '.markuplm_features',
+                                         tokenizer)
+    feature_cache.update(ds_form, processor, args.nproc)
 
-    ds_processed = ds_form.map(preprocess_function, batched=True, num_proc=args.nproc)
-    ds = ds_processed.train_test_split(test_size=0.2, seed=args.seed)
+    ds = ds_form.train_test_split(test_size=0.2, seed=args.seed)
+    train_dataset = CachedFeatureDataset(feature_cache, ds['train']['html_hash'], ds['train']['label'])
+    eval_dataset = CachedFeatureDataset(feature_cache, ds['test']['html_hash'], ds['test']['label'])
 
     id2label = {i: l for i, l in enumerate(LABELS)}
     label2id = {l: i for i, l in enumerate(LABELS)}
@@ -68,39 +105,25 @@ def main():
         load_best_model_at_end=True,
         bf16=True,
         seed=args.seed,
+        group_by_length=args.group_by_length,
+        gradient_checkpointing=args.gradient_checkpointing,
     )
 
     def compute_metrics(eval_pred):
         logits, labels = eval_pred
-        proba = expit(logits)
-
-        hard_labels = np.int32(labels >= 0.5)
-        hard_predicts = np.int32(proba >= 0.5)
-
-        cls_report = classification_report(
-            hard_labels,
-            hard_predicts,
-            target_names=LABELS,
-            output_dict=True,
-            zero_division=np.nan,
-        )
-
-        metrics = {
-            'accuracy': accuracy_score(hard_labels, hard_predicts),
-        }
-
-        for key1, d1 in cls_report.items():
-            for key2, value in d1.items():
-                metrics[f'{key1}/{key2}'] = value
-
-        return metrics
+        return compute_classification_metrics(labels, expit(logits))
 
     trainer = Trainer(
         model=model,
         args=training_args,
-        train_dataset=ds['train'],
-        eval_dataset=ds['test'],
+        train_dataset=train_dataset,
+        eval_dataset=eval_dataset,
+        data_collator=functools.partial(
+            feature_cache.collate,
+            pad_to_length=tokenizer.model_max_length if args.pad_to_max_length else None,
+        ),
         compute_metrics=compute_metrics,
+        callbacks=[EpochThroughputCallback(len(train_dataset))],
     )
 
     trainer.train()
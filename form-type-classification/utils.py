@@ -1,3 +1,4 @@
+import hashlib
 import html
 import json
 import os
@@ -6,7 +7,10 @@ from collections import Counter
 from pathlib import Path
 
 import bs4
+import numpy as np
 from bs4 import BeautifulSoup
+from sklearn.metrics import accuracy_score, classification_report
+from torch.utils.data import Sampler
 from transformers import MarkupLMFeatureExtractor
 
 sys.path.insert(0, os.path.join(sys.path[0], '..', 'pylib'))
@@ -119,36 +123,117 @@ LABELS = [
 ]
 
 
-def load_html_string(example, root_dir):
-    root_dir = Path(root_dir)
+def compute_classification_metrics(labels, proba):
+    """Compute accuracy and per-label metrics from soft labels and predicted probabilities."""
+    hard_labels = np.int32(np.asarray(labels) >= 0.5)
+    hard_predicts = np.int32(np.asarray(proba) >= 0.5)
+
+    cls_report = classification_report(
+        hard_labels,
+        hard_predicts,
+        target_names=LABELS,
+        output_dict=True,
+        zero_division=np.nan,
+    )
+
+    metrics = {
+        'accuracy': accuracy_score(hard_labels, hard_predicts),
+    }
+
+    for key1, d1 in cls_report.items():
+        for key2, value in d1.items():
+            metrics[f'{key1}/{key2}'] = value
 
-    domain = example['domain']
-    job_hash = example['job_hash']
-    form_filename = example['form_filename']
+    return metrics
 
-    job_dir = root_dir / domain / job_hash
 
+def read_page_title(job_dir):
     with open(job_dir / 'job.json', 'rb') as fin:
         job_data = json.load(fin)
 
-    page_title = job_data["pageTitle"].replace('\n', ' ')
+    return job_data["pageTitle"].replace('\n', ' ')
 
+
+def read_html_string(job_dir, form_filename, page_title):
     with open(job_dir / form_filename, 'rb') as fin:
         form_data = json.load(fin)
 
     form_html = form_data["element"]['outerHTML']
 
-    returned_obj = {"html_strings": f'<title>{html.escape(page_title)}</title>{form_html}'}
+    return f'<title>{html.escape(page_title)}</title>{form_html}'
+
+
+def parse_annotations(annotations_json):
+    votes = json.loads(annotations_json)
+    n_votes = len(votes)
+    vote_counter = Counter(RAW_LABEL_MAP.get(i, i) for i in votes)
+
+    if (vote_counter.most_common(1)[0][1] <= n_votes // 2
+        or any((k and k not in LABELS) for k in vote_counter)):
+        return None
+
+    return [vote_counter[i] / n_votes for i in LABELS]
+
+
+def load_html_strings(examples, root_dir):
+    """Load the HTML string (page title + form HTML) of forms, to be used with `Dataset.map(batched=True)`.
+
+    The page title of each job is read only once per batch, so order the rows by (domain, job_hash) to load all
+    forms of a job together.
+    """
+    root_dir = Path(root_dir)
+    page_titles = {}
+    returned_obj = {"html_strings": [], "html_hash": []}
+
+    for domain, job_hash, form_filename in zip(examples['domain'], examples['job_hash'], examples['form_filename']):
+        job_dir = root_dir / domain / job_hash
+
+        if (page_title := page_titles.get(job_dir)) is None:
+            page_title = page_titles[job_dir] = read_page_title(job_dir)
 
-    if 'annotations' in example:
-        votes = json.loads(example['annotations'])
-        n_votes = len(votes)
-        vote_counter = Counter(RAW_LABEL_MAP.get(i, i) for i in votes)
+        html_string = read_html_string(job_dir, form_filename, page_title)
+        returned_obj["html_strings"].append(html_string)
+        returned_obj["html_hash"].append(hashlib.blake2s(html_string.encode()).hexdigest())
 
-        if (vote_counter.most_common(1)[0][1] <= n_votes // 2
-            or any((k and k not in LABELS) for k in vote_counter)):
-            returned_obj['label'] = None
-        else:
-            returned_obj['label'] = [vote_counter[i] / n_votes for i in LABELS]
+    if 'annotations' in examples:
+        returned_obj['label'] = [parse_annotations(i) for i in examples['annotations']]
 
     return returned_obj
+
+
+class TokenBudgetBatchSampler(Sampler[list[int]]):
+    """Batch sampler that groups examples of similar token lengths.
+
+    Examples are sorted by length (longest first) and packed greedily, so that the padded size of each batch
+    (longest length x number of examples) stays within `max_tokens`. Batches are yielded in that order; callers
+    must carry the example index in the batch to map outputs back to the inputs.
+    """
+
+    def __init__(self, lengths, max_tokens, max_batch_size=None):
+        super().__init__(None)
+
+        self.batches = []
+        batch = []
+        batch_max_length = 0
+
+        for idx in sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True):
+            length = lengths[idx]
+            new_max_length = max(batch_max_length, length)
+
+            if batch and (new_max_length * (len(batch) + 1) > max_tokens
+                          or (max_batch_size and len(batch) >= max_batch_size)):
+                self.batches.append(batch)
+                batch = []
+                new_max_length = length
+
+            batch.append(idx)
+            batch_max_length = new_max_length
+
+        if batch:
+            self.batches.append(batch)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
@@ -1,19 +1,22 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
 import json
+import logging
 import os
-import random
 import sqlite3
 import sys
-from collections import defaultdict
 from pathlib import Path
 
+import numpy as np
 import tiktoken
-from openai import BadRequestError, OpenAI
 
 sys.path.insert(0, os.path.join(sys.path[0], '..', 'pylib'))
-from htmlutil import cleanup_html  # pylint: disable=wrong-import-position
+# pylint: disable=wrong-import-position
+from htmlutil import cleanup_html
+from llmutil import add_engine_arguments, resume_jsonl, run_chat_completions
+from samplingutil import sample_catalog_forms
 
 PROMPT_TEMPLATE = '''
 I will provide the HTML code of a web form. Please analyze the form and identify the types of personal data that are being requested in the form fields.
@@ -50,6 +53,8 @@ Here is the HTML code of the form:
 
 
 def main():
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+
     parser = argparse.ArgumentParser()
     parser.add_argument("root_dir", help="Root directory of the dataset")
     parser.add_argument("output", help="Output path")
@@ -57,108 +62,89 @@ def main():
                         help="How many forms to label")
     parser.add_argument("--min_samples_per_category", type=int, default=40,
                         help="Minimum number of samples per category")
+    parser.add_argument("--seed", type=int, help="Random seed")
     parser.add_argument("--model", default="gpt-4-0125-preview",
                         help="OpenAI model name")
+    add_engine_arguments(parser)
     args = parser.parse_args()
 
     root_dir = Path(args.root_dir)
 
-    con = sqlite3.connect(args.root_dir.rstrip('/') + '.db')
-
-    cur = con.execute('SELECT domain, content_categories FROM domain_info')
-
-    cat_domain_map = defaultdict(list)
-
-    for domain, content_categories_json in cur:
-        content_categories = json.loads(content_categories_json)
-
-        for cat in content_categories:
-            if "super_category_id" in cat:
-                cat_domain_map[cat["name"]].append(domain)
+    # Forms labeled by previous runs count towards the target
+    done_forms = {(data['domain'], data['job_hash'], data['filename']) for data in resume_jsonl(args.output)}
 
-    for cat in list(cat_domain_map.keys()):
-        if len(cat_domain_map[cat]) <= args.min_samples_per_category:
-            cat_domain_map['Other'].extend(cat_domain_map[cat])
-            del cat_domain_map[cat]
-
-    candidate_forms = {}
     tokenizer = tiktoken.encoding_for_model(args.model)
-    client = OpenAI()
-
-    while len(candidate_forms) < args.target:
-        cat = random.choice(list(cat_domain_map.keys()))
-        domain = random.choice(cat_domain_map[cat])
 
-        job_dir = random.choice(list((root_dir / domain).iterdir()))
+    def iter_requests():
+        # Only sampled when requests are made, so that ingesting batch results does not need the form catalog.
+        # Some heuristics to increase the chance of discovering personal data:
+        # POST forms more likely to require personal data, visible forms only, with at least two fields
+        con = sqlite3.connect(args.root_dir.rstrip('/') + '.db')
+        rng = np.random.default_rng(args.seed)
+        all_forms = sample_catalog_forms(con, rng, "method = 'POST' AND is_visible AND n_fields > 1",
+                                         min_domains_per_category=args.min_samples_per_category)
+        con.close()
 
-        try:
-            form_file = random.choice(list(job_dir.glob("form-*.json")))
-        except IndexError:
-            continue
+        candidate_forms = {}
 
-        form_info = json.loads(form_file.read_text())
+        for descriptor in all_forms:
+            if len(candidate_forms) + len(done_forms) >= args.target:
+                break
 
-        try:
-            form_method = form_info['element']['attributes'].get('method')
-            form_html_raw = form_info['element']['outerHTML']
-        except AttributeError:
-            continue
+            if descriptor in done_forms:
+                continue
 
-        # Some heuristics to increase the chance of discovering personal data
+            domain, job_hash, form_filename = descriptor
 
-        # POST forms more likely to require personal data
-        if form_method != 'POST':
-            continue
+            with open(root_dir / domain / job_hash / form_filename, encoding='utf-8') as fin:
+                form_info = json.load(fin)
 
-        # Visible forms only
-        if not form_info['element']['isVisible']:
-            continue
+            form_html, _ = cleanup_html(form_info['element']['outerHTML'], tokenizer)
 
-        # With at least two fields
-        if len(form_info['fields']) <= 1:
-            continue
+            candidate_forms[form_html] = descriptor
+            print(domain, job_hash, form_filename)
 
-        form_html, _ = cleanup_html(form_html_raw, tokenizer)
+        for form_html, descriptor in candidate_forms.items():
+            prompt = PROMPT_TEMPLATE % form_html
 
-        candidate_forms[form_html] = (domain, job_dir.name, form_file.name)
-        print(domain, job_dir.name, form_file.name)
+            yield descriptor, len(tokenizer.encode(prompt)), {
+                'model': args.model,
+                'response_format': {"type": "json_object"},
+                'messages': [
+                    {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
+                    {"role": "user", "content": prompt}
+                ],
+            }
+
+    def save_result(fout, descriptor, response_obj):
+        # Batch results may include forms saved by an earlier ingestion
+        if response_obj is None or descriptor in done_forms:
+            return
+
+        domain, job_hash, form_file = descriptor
+        response = json.loads(response_obj.choices[0].message.content)
+
+        if isinstance(response, dict) and len(response) == 1:
+            response = next(iter(response.values()))
+
+        if not isinstance(response, list):
+            print("Invalid response:", response, file=sys.stderr)
+
+        jsonl_line = json.dumps({
+            "domain": domain,
+            "job_hash": job_hash,
+            "filename": form_file,
+            "response": response,
+        })
+
+        print(response)
+        print(jsonl_line, file=fout)
+        fout.flush()
+        done_forms.add(descriptor)
 
     # Append mode, so previous results are preserved
     with open(args.output, "a", encoding='utf-8') as fout:
-        for form_html, (domain, job_hash, form_file) in candidate_forms.items():
-            prompt = PROMPT_TEMPLATE % form_html
-
-            try:
-                response_obj = client.chat.completions.create(
-                    model=args.model,
-                    response_format={"type": "json_object"},
-                    messages=[
-                        {"role": "system", "content": "You are a helpful assistant designed to output JSON."},
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-            except BadRequestError:
-                print("Bad request!", file=sys.stderr)
-                continue
-
-            response = json.loads(response_obj.choices[0].message.content)
-
-            if isinstance(response, dict) and len(response) == 1:
-                response = next(iter(response.values()))
-
-            if not isinstance(response, list):
-                print("Invalid response:", response, file=sys.stderr)
-
-            jsonl_line = json.dumps({
-                "domain": domain,
-                "job_hash": job_hash,
-                "filename": form_file,
-                "response": response,
-            })
-
-            print(response)
-            print(jsonl_line, file=fout)
-            fout.flush()
+        run_chat_completions(args, iter_requests, functools.partial(save_result, fout))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import tqdm
+
+
+def worker(jobdir):
+    rows = []
+
+    for form_file in sorted(jobdir.glob("form-*.json")):
+        with open(form_file, "r", encoding="utf-8") as fin:
+            form_info = json.load(fin)
+
+        try:
+            method = form_info['element']['attributes'].get('method')
+            is_visible = int(bool(form_info['element']['isVisible']))
+            html_length = len(form_info['element']['outerHTML'])
+        except (AttributeError, KeyError, TypeError):
+            # Keep unusable forms in the catalog so that per-job form counts stay correct
+            method = is_visible = html_length = None
+
+        rows.append((form_file.name, method, is_visible, len(form_info.get('fields') or []), html_length))
+
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rootdir")
+    parser.add_argument("--nproc", type=int, help="Number of processes")
+    args = parser.parse_args()
+
+    rootdir = Path(args.rootdir)
+
+    con = sqlite3.connect(args.rootdir.rstrip('/') + '.db')
+
+    con.execute('DROP TABLE IF EXISTS form_catalog')
+    con.execute('''CREATE TABLE form_catalog (
+        domain TEXT NOT NULL,
+        job_hash TEXT NOT NULL,
+        form_filename TEXT NOT NULL,
+        method TEXT,
+        is_visible INTEGER,
+        n_fields INTEGER NOT NULL,
+        html_length INTEGER,
+        UNIQUE(job_hash, form_filename)
+    ) STRICT''')
+
+    con.execute('DROP TABLE IF EXISTS form_catalog_domains')
+    con.execute('''CREATE TABLE form_catalog_domains (
+        domain TEXT PRIMARY KEY,
+        n_jobs INTEGER NOT NULL,
+        categories TEXT NOT NULL
+    ) STRICT''')
+
+    # Content categories (only those under a super category) of each domain
+    domain_categories = {}
+
+    for domain, content_categories_json in con.execute('SELECT domain, content_categories FROM domain_info'):
+        content_categories = json.loads(content_categories_json)
+        domain_categories[domain] = [cat["name"] for cat in content_categories if "super_category_id" in cat]
+
+    task_dict = {}
+    domain_jobs = {}
+
+    for sitedir in rootdir.iterdir():
+        if sitedir.is_dir():
+            jobdirs = [d for d in sitedir.iterdir() if d.is_dir()]
+            domain_jobs[sitedir.name] = len(jobdirs)
+
+            for jobdir in jobdirs:
+                task_dict[jobdir] = (sitedir.name, jobdir.name)
+
+    con.executemany('INSERT INTO form_catalog_domains VALUES (?, ?, ?)', (
+        (domain, n_jobs, json.dumps(domain_categories.get(domain, [])))
+        for domain, n_jobs in domain_jobs.items()
+    ))
+
+    with ProcessPoolExecutor(args.nproc) as executor:
+        results = executor.map(worker, task_dict, chunksize=64)
+
+        for rows, (domain, job_hash) in zip(results, tqdm.tqdm(task_dict.values())):
+            con.executemany('INSERT INTO form_catalog VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            ((domain, job_hash, *row) for row in rows))
+
+    con.commit()
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
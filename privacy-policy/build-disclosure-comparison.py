@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+import argparse
+import sqlite3
+
+# SQLite integers are signed 64-bit
+MAX_PI_TYPES = 63
+
+# Input rows the comparison depends on: {name: (key, columns, query)}. The earlier stages rewrite their tables from
+# scratch, so there is no timestamp to tell what changed. Instead, the rows of the last build are kept in
+# `form_disclosure_<name>` tables and diffed against the current ones, which are put in `temp.<name>`. This is cheap
+# next to the comparison itself, which expands the JSON columns.
+SOURCES = {
+    'form_source': ('job_hash, form_filename', '''
+        job_hash TEXT NOT NULL,
+        form_filename TEXT NOT NULL,
+        domain TEXT NOT NULL,
+        field_list TEXT,
+        form_type TEXT NOT NULL,
+        PRIMARY KEY(job_hash, form_filename)
+    ''', '''
+        SELECT fc.job_hash, fc.form_filename, fc.domain, fc.field_list, f.form_type
+        FROM field_classification AS fc
+             INNER JOIN form_classification AS f USING (job_hash, form_filename)
+    '''),
+    'link_source': ('job_hash, form_filename', '''
+        job_hash TEXT NOT NULL,
+        form_filename TEXT NOT NULL,
+        domain TEXT NOT NULL,
+        scope TEXT NOT NULL,
+        policy_url TEXT,
+        PRIMARY KEY(job_hash, form_filename)
+    ''', '''
+        SELECT pl.job_hash, pl.form_filename, pl.domain, pl.scope, pln.normalized_url
+        FROM privacy_policy_link AS pl
+             LEFT JOIN privacy_policy_link_normalized AS pln USING (url)
+    '''),
+    'policy_source': ('url', '''
+        url TEXT PRIMARY KEY,
+        disclosures TEXT NOT NULL
+    ''', '''
+        SELECT url, disclosures FROM privacy_policy_disclosures
+    '''),
+}
+
+# Every comparison row depends only on inputs from its own domain (and the policies linked there), so the domains
+# with changed inputs are the ones to recompute
+CHANGED_DOMAINS_QUERY = '''
+    WITH changed_policies AS (
+        SELECT url FROM (SELECT * FROM temp.policy_source EXCEPT SELECT * FROM form_disclosure_policy_source)
+        UNION
+        SELECT url FROM (SELECT * FROM form_disclosure_policy_source EXCEPT SELECT * FROM temp.policy_source)
+    )
+    SELECT domain FROM (SELECT * FROM temp.form_source EXCEPT SELECT * FROM form_disclosure_form_source)
+    UNION
+    SELECT domain FROM (SELECT * FROM form_disclosure_form_source EXCEPT SELECT * FROM temp.form_source)
+    UNION
+    SELECT domain FROM (SELECT * FROM temp.link_source EXCEPT SELECT * FROM form_disclosure_link_source)
+    UNION
+    SELECT domain FROM (SELECT * FROM form_disclosure_link_source EXCEPT SELECT * FROM temp.link_source)
+    UNION
+    SELECT domain FROM temp.link_source WHERE policy_url IN changed_policies
+'''
+
+# One row per form with PI fields on a domain in `changed_domains`. Bitmasks are over the bits in `pi_type_bits`:
+#   collected: PI types collected by the form's fields
+#   disclosed: PI types disclosed by the privacy policy linked from the form (0 if none)
+#   undisclosed: collected & ~disclosed
+#   domain_disclosed: PI types disclosed by any privacy policy linked on the domain
+COMPARISON_QUERY = '''
+    WITH forms AS (
+        SELECT * FROM temp.form_source
+        WHERE domain IN temp.changed_domains
+    ),
+    links AS (
+        SELECT * FROM temp.link_source
+        WHERE domain IN temp.changed_domains
+    ),
+    collected AS (
+        SELECT field_list, SUM(DISTINCT 1 << bit) AS mask
+        FROM (SELECT DISTINCT field_list FROM forms WHERE field_list IS NOT NULL) AS fl,
+             json_each(fl.field_list) AS j
+             INNER JOIN pi_type_bits ON pi_type = j.value
+        GROUP BY field_list
+    ),
+    disclosed AS (
+        SELECT url, SUM(1 << bit) AS mask
+        FROM temp.policy_source AS pd, json_each(pd.disclosures) AS j
+             INNER JOIN pi_type_bits ON pi_type = j.key
+        WHERE url IN (SELECT policy_url FROM links)
+        GROUP BY url
+    ),
+    domain_disclosed AS (
+        SELECT domain, SUM(b) AS mask
+        FROM (
+            SELECT DISTINCT l.domain, 1 << bit AS b
+            FROM links AS l
+                 INNER JOIN temp.policy_source AS pd ON pd.url = l.policy_url,
+                 json_each(pd.disclosures) AS j
+                 INNER JOIN pi_type_bits ON pi_type = j.key
+        )
+        GROUP BY domain
+    )
+    SELECT
+        f.domain, f.job_hash, f.form_filename, f.form_type, l.scope, l.policy_url,
+        COALESCE(c.mask, 0),
+        COALESCE(d.mask, 0),
+        COALESCE(c.mask, 0) & ~COALESCE(d.mask, 0),
+        COALESCE(dd.mask, 0)
+    FROM forms AS f
+         LEFT JOIN links AS l USING (job_hash, form_filename)
+         LEFT JOIN collected AS c ON c.field_list = f.field_list
+         LEFT JOIN disclosed AS d ON d.url = l.policy_url
+         LEFT JOIN domain_disclosed AS dd ON dd.domain = f.domain
+'''
+
+
+def update_pi_type_bits(con):
+    """Assign bits to PI types not seen before. Existing assignments never change, so stored bitmasks stay valid.
+
+    Only inputs that changed since the last build can have new PI types, so the others are not looked into.
+    """
+    con.execute('''CREATE TABLE IF NOT EXISTS pi_type_bits (
+        bit INTEGER PRIMARY KEY,
+        pi_type TEXT UNIQUE NOT NULL
+    ) STRICT''')
+
+    known_types = {pi_type for pi_type, in con.execute('SELECT pi_type FROM pi_type_bits')}
+    cur = con.execute('''
+        SELECT j.value
+        FROM (SELECT field_list FROM temp.form_source EXCEPT SELECT field_list FROM form_disclosure_form_source) AS fc,
+             json_each(fc.field_list) AS j
+        UNION
+        SELECT j.key
+        FROM (SELECT disclosures FROM temp.policy_source EXCEPT SELECT disclosures FROM form_disclosure_policy_source)
+             AS pd, json_each(pd.disclosures) AS j
+    ''')
+    new_types = sorted({pi_type for pi_type, in cur} - known_types)
+    next_bit = len(known_types)
+
+    if next_bit + len(new_types) > MAX_PI_TYPES:
+        raise ValueError(f"Too many PI types to fit in a bitmask: {next_bit + len(new_types)}")
+
+    con.executemany('INSERT INTO pi_type_bits VALUES (?, ?)', enumerate(new_types, next_bit))
+
+    return new_types
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rootdir")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild from scratch, reassigning PI type bits")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.rootdir.rstrip('/') + '.db')
+
+    if args.rebuild:
+        con.execute('DROP TABLE IF EXISTS form_disclosure_comparison')
+        con.execute('DROP TABLE IF EXISTS pi_type_bits')
+
+        for name in SOURCES:
+            con.execute(f'DROP TABLE IF EXISTS form_disclosure_{name}')
+
+    con.execute('''CREATE TABLE IF NOT EXISTS form_disclosure_comparison (
+        domain TEXT NOT NULL,
+        job_hash TEXT NOT NULL,
+        form_filename TEXT NOT NULL,
+        form_type TEXT NOT NULL,
+        scope TEXT,
+        policy_url TEXT,
+        collected INTEGER NOT NULL,
+        disclosed INTEGER NOT NULL,
+        undisclosed INTEGER NOT NULL,
+        domain_disclosed INTEGER NOT NULL,
+        PRIMARY KEY(job_hash, form_filename)
+    ) STRICT, WITHOUT ROWID''')
+    con.execute('CREATE INDEX IF NOT EXISTS form_disclosure_comparison_domain ON form_disclosure_comparison (domain)')
+    con.execute('''CREATE INDEX IF NOT EXISTS form_disclosure_comparison_form_type
+                   ON form_disclosure_comparison (form_type, scope)''')
+    con.execute('''CREATE INDEX IF NOT EXISTS form_disclosure_comparison_policy_url
+                   ON form_disclosure_comparison (policy_url)''')
+
+    # Without a comparison to update (e.g., the table was dropped), everything is computed again
+    is_empty = con.execute('SELECT 1 FROM form_disclosure_comparison LIMIT 1').fetchone() is None
+
+    for name, (_, columns, query) in SOURCES.items():
+        con.execute(f'CREATE TABLE IF NOT EXISTS form_disclosure_{name} ({columns}) STRICT, WITHOUT ROWID')
+        con.execute(f'CREATE TEMP TABLE {name} ({columns}) STRICT, WITHOUT ROWID')
+        con.execute(f'INSERT INTO temp.{name} {query}')
+
+        if is_empty:
+            con.execute(f'DELETE FROM form_disclosure_{name}')
+
+    if new_types := update_pi_type_bits(con):
+        print("New PI types:", ", ".join(new_types))
+
+    con.execute(f'CREATE TEMP TABLE changed_domains AS {CHANGED_DOMAINS_QUERY}')
+    n_domains, = con.execute('SELECT COUNT(*) FROM temp.changed_domains').fetchone()
+
+    # Only the changed domains are recomputed, and only rows that differ are written
+    con.execute(f'CREATE TEMP TABLE comparison AS {COMPARISON_QUERY}')
+
+    n_deleted = con.execute('''
+        DELETE FROM form_disclosure_comparison
+        WHERE domain IN temp.changed_domains AND (job_hash, form_filename) NOT IN (
+            SELECT job_hash, form_filename FROM temp.comparison
+        )
+    ''').rowcount
+    n_upserted = con.execute('''
+        INSERT OR REPLACE INTO form_disclosure_comparison
+        SELECT * FROM temp.comparison EXCEPT SELECT * FROM form_disclosure_comparison
+    ''').rowcount
+    n_total, = con.execute('SELECT COUNT(*) FROM form_disclosure_comparison').fetchone()
+
+    # Keep the inputs of this build for the next one
+    for name, (key, _, _) in SOURCES.items():
+        con.execute(f'DELETE FROM form_disclosure_{name} WHERE ({key}) NOT IN (SELECT {key} FROM temp.{name})')
+        con.execute(f'''INSERT OR REPLACE INTO form_disclosure_{name}
+                        SELECT * FROM temp.{name} EXCEPT SELECT * FROM form_disclosure_{name}''')
+
+    con.commit()
+    con.close()
+
+    print(f"Domains recomputed: {n_domains}, forms: {n_total}, updated: {n_upserted}, deleted: {n_deleted}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""Download all privacy policies in the database with one browser and concurrent browser contexts."""
+
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+import urllib.parse as urlparse
+from collections import Counter
+
+import requests
+from crawl_frontier import CrawlFrontier
+from html_crawler import CrawlError, HTTPStatusError, crawl_page, get_readability_js, launch_browser, url_arg_handler
+from playwright.async_api import Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError, async_playwright
+
+# How often idle workers look for URLs that have become eligible (at most and at least)
+POLL_INTERVAL = 0.5
+MIN_POLL_INTERVAL = 0.05
+
+
+def get_output_dir(outdir, url):
+    return os.path.join(outdir, hashlib.blake2s(url.encode()).hexdigest())
+
+
+def classify_error(e):
+    """Return the error class of a failed attempt and whether it is worth retrying."""
+    if isinstance(e, HTTPStatusError):
+        return 'http', e.status_code == 429 or e.status_code >= 500
+    if isinstance(e, CrawlError):
+        # Page loaded but is not an English privacy policy: retrying will not help
+        return 'content', False
+    if isinstance(e, PlaywrightTimeoutError):
+        return 'timeout', True
+    if isinstance(e, PlaywrightError):
+        return 'browser', True
+    if isinstance(e, (requests.RequestException, ConnectionError)):
+        return 'connect', True
+
+    # Anything unexpected (e.g., an OSError while saving the page) fails only this URL
+    return 'other', True
+
+
+async def crawl_all(frontier, outdir, concurrency, per_host, host_delay, readability_js, no_readability_js):
+    active_hosts = Counter()
+    last_start = {}
+
+    def get_busy_hosts(now):
+        # Hosts at the concurrency limit, or that were visited too recently
+        for host, t in list(last_start.items()):
+            if now - t >= host_delay:
+                del last_start[host]
+
+        return {h for h, n in active_hosts.items() if n >= per_host} | set(last_start)
+
+    async with async_playwright() as p:
+        browser = await launch_browser(p)
+        browser_lock = asyncio.Lock()
+
+        async def get_browser():
+            nonlocal browser
+
+            async with browser_lock:
+                if not browser.is_connected():
+                    logging.warning("Browser disconnected. Relaunching...")
+                    browser = await launch_browser(p)
+
+            return browser
+
+        async def worker():
+            while True:
+                now = time.time()
+                busy_hosts = get_busy_hosts(now)
+
+                if (claimed := frontier.claim(busy_hosts, now)) is None:
+                    # Stop once nothing is pending and no running crawl can reschedule a URL
+                    if frontier.next_eligible_time() is None and not sum(active_hosts.values()):
+                        break
+
+                    # Wake up when a URL on a free host becomes eligible or a host delay runs out. Hosts at the
+                    # concurrency limit are polled for, but never with a zero sleep that would spin on the database.
+                    wake_times = [t + host_delay for t in last_start.values()]
+
+                    if (next_time := frontier.next_eligible_time(busy_hosts)) is not None:
+                        wake_times.append(next_time)
+
+                    delay = min((t - now for t in wake_times), default=POLL_INTERVAL)
+                    await asyncio.sleep(min(max(delay, MIN_POLL_INTERVAL), POLL_INTERVAL))
+                    continue
+
+                url, host = claimed
+                active_hosts[host] += 1
+                last_start[host] = now
+
+                try:
+                    # HEAD requests (and Google Docs exports) are blocking
+                    access_url = await asyncio.to_thread(url_arg_handler, url)
+
+                    if access_url is None:
+                        raise ConnectionError("URL failed pre-tests")
+
+                    await crawl_page(await get_browser(), access_url, get_output_dir(outdir, url),
+                                     readability_js, no_readability_js)
+                except Exception as e:  # pylint: disable=broad-exception-caught
+                    error_class, retryable = classify_error(e)
+                    message = str(e).strip().split('\n', 1)[0]
+
+                    if error_class == 'other':
+                        message = f"{type(e).__name__}: {message}"
+
+                    if (next_time := frontier.mark_failed(url, error_class, message, retryable)) is None:
+                        logging.error("%s: %s (giving up)", url, message)
+                    else:
+                        logging.warning("%s: %s (retry in %.0fs)", url, message, next_time - time.time())
+                else:
+                    frontier.mark_done(url)
+                finally:
+                    active_hosts[host] -= 1
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        await browser.close()
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rootdir")
+    parser.add_argument("outdir")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of concurrent browser contexts")
+    parser.add_argument("--per-host", type=int, default=2, help="Max concurrent pages per host")
+    parser.add_argument("--host-delay", type=float, default=1.0, help="Min seconds between starting pages on a host")
+    parser.add_argument("--max-attempts", type=int, default=4, help="Attempts per URL before giving up")
+    parser.add_argument("--backoff", type=float, default=60.0, help="Seconds before the first retry, doubled after")
+    parser.add_argument("--retry-failed", action="store_true", help="Retry URLs that failed in previous runs")
+    parser.add_argument("--readability-js", help="Local copy of readability.js (default: download once)")
+    parser.add_argument("--no-readability-js", action="store_true", help="Disable readability.js")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.rootdir.rstrip('/') + '.db')
+    cur = con.execute('SELECT DISTINCT normalized_url FROM privacy_policy_link_normalized')
+    all_urls = sorted(d for d, in cur)
+
+    frontier = CrawlFrontier(con, max_attempts=args.max_attempts, backoff=args.backoff)
+    frontier.add_urls((u, urlparse.urlsplit(u).hostname or '') for u in all_urls)
+
+    # Output folders are the ground truth of what has been crawled (same as `test -e <out_dir>`)
+    frontier.sync_done(u for u in all_urls if os.path.exists(get_output_dir(args.outdir, u)))
+
+    if args.retry_failed:
+        frontier.retry_failed()
+
+    logging.info("Frontier: %r", frontier.stats())
+
+    os.makedirs(args.outdir, exist_ok=True)
+
+    asyncio.run(crawl_all(frontier, args.outdir, args.concurrency, args.per_host, args.host_delay,
+                          get_readability_js(args.readability_js), args.no_readability_js))
+
+    logging.info("Frontier: %r", frontier.stats())
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,125 @@
+import json
+import time
+
+PENDING = 'pending'
+IN_PROGRESS = 'in_progress'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class CrawlFrontier:
+    """Crawl state of privacy policy URLs, stored in the `privacy_policy_crawl` table.
+
+    Each URL has a status, the class and message of its last error, the number of attempts so far, and the earliest
+    time (Unix timestamp) it may be attempted again. Failed attempts that are worth retrying are rescheduled with
+    exponential backoff until `max_attempts` is reached. URLs left in progress by an interrupted run are returned to
+    pending when the frontier is opened, so a restart resumes where the last run stopped.
+    """
+
+    def __init__(self, con, max_attempts=4, backoff=60.0, max_backoff=3600.0):
+        self.con = con
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        con.execute('''CREATE TABLE IF NOT EXISTS privacy_policy_crawl (
+            url TEXT PRIMARY KEY,
+            host TEXT NOT NULL,
+            status TEXT NOT NULL,
+            error_class TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_eligible REAL NOT NULL DEFAULT 0
+        ) STRICT''')
+        con.execute('''CREATE INDEX IF NOT EXISTS privacy_policy_crawl_schedule
+                       ON privacy_policy_crawl (status, next_eligible)''')
+        con.execute('UPDATE privacy_policy_crawl SET status = ? WHERE status = ?', (PENDING, IN_PROGRESS))
+        con.commit()
+
+    def add_urls(self, url_hosts):
+        """Add (url, host) pairs as pending. URLs already in the frontier keep their state."""
+        self.con.executemany('INSERT OR IGNORE INTO privacy_policy_crawl (url, host, status) VALUES (?, ?, ?)',
+                             ((url, host, PENDING) for url, host in url_hosts))
+        self.con.commit()
+
+    def sync_done(self, done_urls):
+        """Make the done status agree with the saved outputs.
+
+        URLs in `done_urls` (e.g., crawled by html_crawler.py directly) are marked as done, and done URLs whose
+        output has gone missing are crawled again from scratch.
+        """
+        done_urls = set(done_urls)
+        cur = self.con.execute('SELECT url, status FROM privacy_policy_crawl')
+        rows = cur.fetchall()
+
+        self.con.executemany('''UPDATE privacy_policy_crawl
+                                SET status = ?, error_class = NULL, error = NULL WHERE url = ?''',
+                             ((DONE, url) for url, status in rows if url in done_urls and status != DONE))
+        self.con.executemany('''UPDATE privacy_policy_crawl
+                                SET status = ?, attempts = 0, next_eligible = 0 WHERE url = ?''',
+                             ((PENDING, url) for url, status in rows if url not in done_urls and status == DONE))
+        self.con.commit()
+
+    def retry_failed(self):
+        """Give URLs that ran out of attempts (or failed permanently) a fresh start."""
+        self.con.execute('UPDATE privacy_policy_crawl SET status = ?, attempts = 0, next_eligible = 0 WHERE status = ?',
+                         (PENDING, FAILED))
+        self.con.commit()
+
+    def claim(self, excluded_hosts=(), now=None):
+        """Mark the pending URL that has been eligible the longest, and not on an excluded host, as in progress.
+
+        Returns (url, host), or None if no URL can be crawled now.
+        """
+        now = time.time() if now is None else now
+
+        row = self.con.execute('''
+            SELECT url, host FROM privacy_policy_crawl
+            WHERE status = ? AND next_eligible <= ? AND host NOT IN (SELECT value FROM json_each(?))
+            ORDER BY next_eligible, url LIMIT 1
+        ''', (PENDING, now, json.dumps(list(excluded_hosts)))).fetchone()
+
+        if row is not None:
+            self.con.execute('UPDATE privacy_policy_crawl SET status = ? WHERE url = ?', (IN_PROGRESS, row[0]))
+            self.con.commit()
+
+        return row
+
+    def next_eligible_time(self, excluded_hosts=()):
+        """Earliest time any pending URL not on an excluded host becomes eligible, or None if there is none."""
+        return self.con.execute('''
+            SELECT MIN(next_eligible) FROM privacy_policy_crawl
+            WHERE status = ? AND host NOT IN (SELECT value FROM json_each(?))
+        ''', (PENDING, json.dumps(list(excluded_hosts)))).fetchone()[0]
+
+    def mark_done(self, url):
+        self.con.execute('''UPDATE privacy_policy_crawl
+                            SET status = ?, error_class = NULL, error = NULL, attempts = attempts + 1
+                            WHERE url = ?''', (DONE, url))
+        self.con.commit()
+
+    def mark_failed(self, url, error_class, error, retryable, now=None):
+        """Record a failed attempt. Returns the time of the next attempt, or None if the URL has failed for good."""
+        now = time.time() if now is None else now
+        attempts, = self.con.execute('SELECT attempts + 1 FROM privacy_policy_crawl WHERE url = ?', (url,)).fetchone()
+
+        if retryable and attempts < self.max_attempts:
+            status = PENDING
+            next_eligible = now + min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+        else:
+            status = FAILED
+            next_eligible = None
+
+        self.con.execute('''UPDATE privacy_policy_crawl
+                            SET status = ?, error_class = ?, error = ?, attempts = ?, next_eligible = ?
+                            WHERE url = ?''',
+                         (status, error_class, error, attempts, next_eligible or now, url))
+        self.con.commit()
+
+        return next_eligible
+
+    def stats(self):
+        """Number of URLs by (status, error class)."""
+        cur = self.con.execute('''SELECT status, error_class, COUNT(*) FROM privacy_policy_crawl
+                                  GROUP BY status, error_class ORDER BY status, error_class''')
+        return {(status, error_class): count for status, error_class, count in cur}
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import os
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import tqdm
+
+# Files saved by html_crawler.py, which are all inputs of PoliGraph-er
+POLICY_FILES = ['accessibility_tree.json', 'cleaned.html', 'readability.json']
+
+
+def hash_policy(pp_dir):
+    h = hashlib.blake2s()
+
+    for filename in POLICY_FILES:
+        with open(os.path.join(pp_dir, filename), 'rb') as fin:
+            content = fin.read()
+
+        # Length prefix, so that content cannot shift between files
+        h.update(len(content).to_bytes(8, 'little'))
+        h.update(content)
+
+    return h.hexdigest()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rootdir")
+    parser.add_argument("privacy_policy_dir")
+    parser.add_argument("--nproc", type=int, help="Number of processes")
+    parser.add_argument("--output", help="Write the folders of unique policies to this file, one per line")
+    args = parser.parse_args()
+
+    con = sqlite3.connect(args.rootdir.rstrip('/') + '.db')
+
+    cur = con.execute('SELECT DISTINCT normalized_url FROM privacy_policy_link_normalized')
+    pp_dirs = {}
+
+    for url, in cur:
+        pp_dir = os.path.join(args.privacy_policy_dir, hashlib.blake2s(url.encode()).hexdigest())
+
+        if os.path.exists(pp_dir):
+            pp_dirs[url] = pp_dir
+
+    content_groups = defaultdict(list)
+
+    with ProcessPoolExecutor(args.nproc) as executor:
+        results = executor.map(hash_policy, pp_dirs.values(), chunksize=64)
+
+        for content_hash, url in zip(results, tqdm.tqdm(pp_dirs)):
+            content_groups[content_hash].append(url)
+
+    # The smallest URL of each group is the one whose folder is processed by PoliGraph-er
+    rows = []
+
+    for content_hash, urls in content_groups.items():
+        canonical_url = min(urls)
+        rows.extend((url, content_hash, canonical_url) for url in urls)
+
+    con.execute('DROP TABLE IF EXISTS privacy_policy_dedup')
+    con.execute('''CREATE TABLE privacy_policy_dedup (
+        url TEXT PRIMARY KEY,
+        content_hash TEXT NOT NULL,
+        canonical_url TEXT NOT NULL
+    ) STRICT''')
+    con.executemany('INSERT INTO privacy_policy_dedup VALUES (?, ?, ?)', sorted(rows))
+    con.commit()
+    con.close()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as fout:
+            for url in sorted(min(urls) for urls in content_groups.values()):
+                print(pp_dirs[url], file=fout)
+
+    n_policies = len(pp_dirs)
+    n_unique = len(content_groups)
+
+    print("Privacy policies:", n_policies)
+    print("Unique privacy policies:", n_unique)
+    print(f"Duplicate ratio: {(n_policies - n_unique) / max(n_policies, 1):.2%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -8,16 +8,23 @@ import os
 import queue
 import re
 import sqlite3
+import sys
+import tempfile
+import time
 import urllib.parse as urlparse
 import warnings
 from pathlib import Path
 
 import numpy as np
-import tldextract
 import tqdm
-import whatwg_url
-from bs4 import BeautifulSoup
+from link_prefilter import LinkPrefilter
 from sklearn.metrics.pairwise import cosine_similarity
+from similarity_cache import SimilarityCache
+
+sys.path.insert(0, os.path.join(sys.path[0], '..', 'pylib'))
+# pylint: disable=wrong-import-position
+from htmlutil import extract_anchors
+from urlutil import extract_domain, resolve_url
 
 SEED_PHRASES = [
     'privacy policy',
@@ -33,9 +40,44 @@ RePhraseMatcher = re.compile(
     re.IGNORECASE
 )
 
-def cpu_worker(args: tuple[mp.Queue, Path, str], match_threshold=0.75):
-    gpu_queue, rootdir, domain = args
-    conn, conn_other = mp.Pipe()
+def init_cpu_worker(request_queue: mp.Queue, prefilter_path: str | None, page_cache_path: str):
+    global _request_queue, _response_recv_conn, _response_send_conn, _prefilter, _page_cache
+    _request_queue = request_queue
+    # Each CPU worker has its own response pipe, so a worker that replaces another one needs no setup
+    _response_recv_conn, _response_send_conn = mp.Pipe(duplex=False)
+    _prefilter = LinkPrefilter.load(prefilter_path) if prefilter_path else None
+    _page_cache = sqlite3.connect(page_cache_path, timeout=60)
+
+
+def get_similarity_scores(features: list[str]) -> np.ndarray:
+    if _prefilter is None:
+        needed_features = features
+    else:
+        # Features screened out cannot reach the match threshold, so their exact scores do not change the result.
+        # Seed phrase matches are always embedded, as their scores decide between links above the threshold.
+        needed = _prefilter.needs_embedding(features)
+        needed |= np.fromiter((RePhraseMatcher.search(f) is not None for f in features), dtype=bool,
+                              count=len(features))
+        needed_features = [f for f, n in zip(features, needed) if n]
+
+    if needed_features:
+        # Each CPU worker has at most one request in flight, answered through the pipe sent along with it
+        _request_queue.put((_response_send_conn, needed_features))
+        needed_scores = np.frombuffer(_response_recv_conn.recv_bytes(), dtype=np.float16)
+    else:
+        needed_scores = np.zeros(0, dtype=np.float16)
+
+    if _prefilter is None:
+        return needed_scores
+
+    sim_scores = np.zeros(len(features), dtype=np.float16)
+    sim_scores[needed] = needed_scores
+    return sim_scores
+
+
+def cpu_worker(args: tuple[Path, str, list[str]], match_threshold=0.75):
+    rootdir, domain, job_hashes = args
+    start_time = time.perf_counter()
 
     @functools.cache
     def get_job_info(job_hash: str) -> tuple[str, list[str]]:
@@ -49,30 +91,37 @@ def cpu_worker(args: tuple[mp.Queue, Path, str], match_threshold=0.75):
 
     @functools.cache
     def check_page(job_hash: str):
+        # Jobs of one domain may be split across workers, which share page results (mostly parent pages)
+        row = _page_cache.execute('SELECT text, url FROM page_result WHERE job_hash = ?', (job_hash,)).fetchone()
+
+        if row is not None:
+            return None if row[1] is None else row
+
         page_url, _ = get_job_info(job_hash)
 
         with open(rootdir / domain / job_hash / "page.html", "rb") as fin:
-            soup = BeautifulSoup(fin, 'lxml')
+            anchors, encoding = extract_anchors(fin.read())
+
+        result = check_privacy_policy_links(anchors, page_url, encoding)
+
+        _page_cache.execute('INSERT OR IGNORE INTO page_result VALUES (?, ?, ?)', (job_hash, *(result or (None, None))))
+        _page_cache.commit()
 
-        return check_privacy_policy_soup(soup, page_url)
+        return result
 
-    def check_privacy_policy_soup(soup: BeautifulSoup, page_url: str) -> tuple[str, str] | None:
-        core_domain = tldextract.extract(page_url).domain
+    def check_privacy_policy_links(anchors: list[tuple[str, str]], page_url: str,
+                                   encoding: str | None) -> tuple[str, str] | None:
+        core_domain = extract_domain(page_url).domain
 
         # Collect unique pairs of (text, url)
         _unique_hrefs = set()
 
-        for a_elem in soup.find_all('a', {"href": True}):
-            text = a_elem.get_text().strip()
+        for text, href in anchors:
+            full_url = resolve_url(href, page_url, encoding or 'utf-8')
 
-            try:
-                full_url = whatwg_url.parse_url(a_elem.get('href'), base=page_url,
-                                                encoding=soup.original_encoding or 'utf-8')
-            except whatwg_url.UrlParserError:
-                continue
-
-            if full_url.scheme in ('http', 'https'):
-                _unique_hrefs.add((text, full_url.href))
+            # Serialized URLs always have lowercase schemes
+            if full_url is not None and full_url.startswith(('http:', 'https:')):
+                _unique_hrefs.add((text, full_url))
 
         if not _unique_hrefs:
             return None
@@ -97,13 +146,12 @@ def cpu_worker(args: tuple[mp.Queue, Path, str], match_threshold=0.75):
             features.append(last_part)
 
         # Get text similarity scores
-        gpu_queue.put((conn_other, features))
-        sim_scores: np.ndarray = conn.recv()
+        sim_scores = get_similarity_scores(features)
         scores = np.maximum(scores, sim_scores.reshape(-1, 2).max(1))
 
         # Prioritize links that are in the same domain
         domain_match = np.fromiter(
-            (tldextract.extract(url).domain == core_domain for _, url in unique_hrefs),
+            (extract_domain(url).domain == core_domain for _, url in unique_hrefs),
             dtype=bool,
         )
 
@@ -118,9 +166,8 @@ def cpu_worker(args: tuple[mp.Queue, Path, str], match_threshold=0.75):
     def _check():
         all_results = {}
 
-        for job_dir in (rootdir / domain).iterdir():
-            job_hash = job_dir.name
-            form_files = list(job_dir.glob('form-*.json'))
+        for job_hash in job_hashes:
+            form_files = list((rootdir / domain / job_hash).glob('form-*.json'))
 
             if form_files:
                 page_url, parents = get_job_info(job_hash)
@@ -129,11 +176,10 @@ def cpu_worker(args: tuple[mp.Queue, Path, str], match_threshold=0.75):
                 with f.open("rb") as fin:
                     form_info = json.load(fin)
 
-                form_html = form_info['element']['outerHTML']
-                form_soup = BeautifulSoup(form_html, 'lxml')
+                form_anchors, encoding = extract_anchors(form_info['element']['outerHTML'])
 
                 # Check the form for links
-                if href := check_privacy_policy_soup(form_soup, page_url):
+                if href := check_privacy_policy_links(form_anchors, page_url, encoding):
                     all_results[domain, job_hash, f.name] = ('FORM', *href)
                     continue
 
@@ -153,10 +199,10 @@ def cpu_worker(args: tuple[mp.Queue, Path, str], match_threshold=0.75):
 
         return all_results
 
-    return _check()
+    return _check(), time.perf_counter() - start_time
 
 
-def gpu_worker(gpu_queue: mp.Queue, worker_index: int, model_name: str):
+def gpu_worker(request_queue: mp.Queue, worker_index: int, model_name: str, cache_path: str):
     warnings.filterwarnings('ignore', module='transformers.utils')
 
     # Disable parallelism in ML libraries
@@ -182,32 +228,47 @@ def gpu_worker(gpu_queue: mp.Queue, worker_index: int, model_name: str):
     model = SentenceTransformer(model_name, device=device)
 
     seed_embeddings = model.encode(SEED_PHRASES)
-    memory: dict[str, float] = {}
+    cache = SimilarityCache(cache_path, model_name)
 
-    while task_tuple := gpu_queue.get():
+    while task_tuple := request_queue.get():
         batch = [task_tuple]
 
         while True:
             try:
-                task_tuple = gpu_queue.get_nowait()
+                task_tuple = request_queue.get_nowait()
             except queue.Empty:
                 break
 
             batch.append(task_tuple)
 
-        all_texts = [t for _, tl in batch for t in tl]
-        new_texts = list({t for t in all_texts if t not in memory})
+        all_texts = list({t for _, tl in batch for t in tl})
+        batch_scores = cache.get_many(all_texts)
+        new_texts = [t for t in all_texts if t not in batch_scores]
 
         if new_texts:
             new_embeddings = model.encode(new_texts)
             # Convert to float16 to mitigate numerical instability
             new_scores = cosine_similarity(new_embeddings, seed_embeddings).max(1).astype(np.float16)
-            memory.update(zip(new_texts, new_scores))
+            new_scores = dict(zip(new_texts, new_scores.tolist()))
+            cache.put_many(new_scores)
+            batch_scores.update(new_scores)
 
-        for conn, features in batch:
-            sim_score = np.fromiter((memory[t] for t in features), dtype=float)
-            conn.send(sim_score)
-            conn.close()
+        for response_conn, features in batch:
+            sim_score = np.fromiter((batch_scores[t] for t in features), dtype=np.float16, count=len(features))
+
+            # The CPU worker may have exited in the meantime
+            try:
+                response_conn.send_bytes(sim_score.tobytes())
+            except OSError:
+                pass
+            finally:
+                response_conn.close()
+
+    stats = cache.stats()
+
+    if stats['memory_hits'] + stats['disk_hits'] + stats['misses'] > 0:
+        print(f"GPU worker {worker_index}: similarity cache hit rate {stats['hit_rate']:.1%} "
+              f"({stats['memory_hits']} memory, {stats['disk_hits']} disk, {stats['misses']} misses)")
 
 
 def main():
@@ -215,9 +276,22 @@ def main():
     parser.add_argument("rootdir")
     parser.add_argument("--n_cpu", type=int, default=os.cpu_count())
     parser.add_argument("--n_gpu", type=int, default=1)
+    parser.add_argument("--jobs_per_task", type=int, default=64,
+                        help="Split domains into tasks of at most this many jobs")
     parser.add_argument("--model", default='sentence-transformers/all-MiniLM-L6-v2')
+    parser.add_argument("--similarity_cache",
+                        help="SQLite file caching link text similarity scores (default: <rootdir>.similarity_cache.db)")
+    parser.add_argument("--no_similarity_cache", action="store_true",
+                        help="Only cache similarity scores in memory during this run")
+    parser.add_argument("--prefilter",
+                        help="Link prefilter trained by train-link-prefilter.py, to skip embedding hopeless links")
     args = parser.parse_args()
 
+    if args.no_similarity_cache:
+        cache_path = ':memory:'
+    else:
+        cache_path = args.similarity_cache or args.rootdir.rstrip('/') + '.similarity_cache.db'
+
     con = sqlite3.connect(args.rootdir.rstrip('/') + '.db')
 
     con.execute('DROP TABLE IF EXISTS privacy_policy_link')
@@ -233,32 +307,63 @@ def main():
 
     cur = con.execute("SELECT DISTINCT domain FROM form_classification")
     all_domains = sorted({d for d, in cur})
-    n_domain = len(all_domains)
 
     rootdir = Path(args.rootdir)
 
-    manager = mp.Manager()
-    gpu_queue = manager.Queue()
+    # Split large domains into job-level tasks, so that they do not become stragglers
+    all_tasks = []
+
+    for domain in all_domains:
+        job_hashes = sorted(d.name for d in (rootdir / domain).iterdir())
+
+        for i in range(0, len(job_hashes), args.jobs_per_task):
+            all_tasks.append((rootdir, domain, job_hashes[i:i + args.jobs_per_task]))
+
+    # Largest tasks first; idle workers then pick up the remaining small ones
+    all_tasks.sort(key=lambda t: len(t[2]), reverse=True)
+
+    # Page results shared by CPU workers during this run
+    page_cache_dir = tempfile.TemporaryDirectory()
+    page_cache_path = os.path.join(page_cache_dir.name, 'page_result.db')
+
+    page_cache = sqlite3.connect(page_cache_path)
+    page_cache.execute('PRAGMA journal_mode=WAL')
+    page_cache.execute('''CREATE TABLE page_result (
+        job_hash TEXT PRIMARY KEY,
+        text TEXT,
+        url TEXT
+    ) STRICT''')
+    page_cache.close()
+
+    # Requests from all CPU workers share one queue; each request carries the response pipe of its CPU worker
+    request_queue = mp.Queue()
 
     # Warm up: make sure the model is downloaded in one process
-    p = mp.Process(target=gpu_worker, args=(gpu_queue, 0, args.model))
+    p = mp.Process(target=gpu_worker, args=(request_queue, 0, args.model, cache_path))
     p.start()
-    gpu_queue.put(None)
+    request_queue.put(None)
     p.join()
 
     # Create GPU workers
     gpu_workers = []
 
     for idx in range(args.n_gpu):
-        p = mp.Process(target=gpu_worker, args=(gpu_queue, idx, args.model))
+        p = mp.Process(target=gpu_worker, args=(request_queue, idx, args.model, cache_path))
         gpu_workers.append(p)
         p.start()
 
     # Run CPU workers
-    with mp.pool.Pool(args.n_cpu) as pool:
-        tasks = pool.imap_unordered(cpu_worker, [(gpu_queue, rootdir, d) for d in all_domains])
+    with mp.pool.Pool(args.n_cpu, initializer=init_cpu_worker,
+                      initargs=(request_queue, args.prefilter, page_cache_path)) as pool:
+        tasks = pool.imap_unordered(cpu_worker, all_tasks)
+        task_times = []
+        finish_times = []
+        start_time = time.perf_counter()
+
+        for results, task_time in tqdm.tqdm(tasks, total=len(all_tasks), smoothing=0.01):
+            task_times.append(task_time)
+            finish_times.append(time.perf_counter() - start_time)
 
-        for results in tqdm.tqdm(tasks, total=n_domain, smoothing=0.01):
             for (domain, job_hash, form_filename), pp_info in results.items():
                 con.execute(
                     'INSERT INTO privacy_policy_link VALUES (?, ?, ?, ?, ?, ?)',
@@ -268,11 +373,21 @@ def main():
 
     # Gracefully shutdown GPU workers
     for idx in range(args.n_gpu):
-        gpu_queue.put(None)
+        request_queue.put(None)
 
     for p in gpu_workers:
         p.join()
 
+    page_cache_dir.cleanup()
+
+    # Tail latency: how long the slowest tasks took, and how long the run waited for the last 1% of them
+    if task_times:
+        tail_start = finish_times[int(len(finish_times) * 0.99)]
+
+        print(f"Task time: p50 {np.percentile(task_times, 50):.1f}s, p99 {np.percentile(task_times, 99):.1f}s, "
+              f"max {max(task_times):.1f}s")
+        print(f"Last 1% of tasks finished in {finish_times[-1] - tail_start:.1f}s of {finish_times[-1]:.1f}s")
+
 
 if __name__ == '__main__':
     main()
@@ -2,6 +2,7 @@
 """Download a web page and export the accessibility tree for parsing."""
 
 import argparse
+import asyncio
 import base64
 import json
 import logging
@@ -12,7 +13,7 @@ import urllib.parse as urlparse
 
 import bs4
 import langdetect
-from playwright.sync_api import TimeoutError as PlaywrightTimeoutError, sync_playwright
+from playwright.async_api import TimeoutError as PlaywrightTimeoutError, async_playwright
 import requests
 from requests_cache import CachedSession
 
@@ -20,8 +21,63 @@ READABILITY_JS_COMMIT = "0e7868abbf206a703dff579d770f2d2a3ae14bc1"
 READABILITY_JS_URL = f"https://raw.githubusercontent.com/mozilla/readability/{READABILITY_JS_COMMIT}"
 REQUESTS_TIMEOUT = 10
 
+FIREFOX_CONFIGS = {
+    # Bypass CSP so we can always inject scripts
+    "security.csp.enable": False,
+    # Allow insecure TLS versions
+    "security.tls.version.min": 1,
+    "security.tls.version.enable-deprecated": True,
+    # Prevent some background traffic
+    "dom.serviceWorkers.enabled": False,
+    "network.websocket.max-connections": 0,
+    "media.autoplay.default": 5,
+    "media.peerconnection.enabled": False,
+    "privacy.trackingprotection.enabled": True,
+    "privacy.trackingprotection.lower_network_priority": True,
+    "privacy.trackingprotection.socialtracking.enabled": True,
+}
+
+APPLY_READABILITY_JS = r"""(no_readability_js) => {
+    window.stop();
+
+    const documentClone = document.cloneNode(true);
+    const article = new Readability(documentClone).parse();
+    if (article !== null) article.applied = false;
+
+    document.querySelectorAll('[aria-hidden=true]').forEach((x) => x.setAttribute("aria-hidden", false));
+
+    if (isProbablyReaderable(document) && !no_readability_js) {
+        documentClone.body.innerHTML = article.content;
+
+        if (documentClone.body.innerText.search(/(data|privacy|cookie)\s*(policy|notice)/) >= 0) {
+            document.body.innerHTML = article.content;
+            article.applied = true;
+        }
+    }
+
+    for (const elem of document.querySelectorAll('script, link, style, header, footer, nav'))
+        elem.remove();
+
+    return article;
+}"""
+
+
+class CrawlError(Exception):
+    """The page failed a check, so nothing is saved for it."""
+
+
+class HTTPStatusError(CrawlError):
+    """The page (or a page it redirected to) returned an HTTP error."""
+
+    def __init__(self, status_code):
+        super().__init__(f"Got HTTP error {status_code}")
+        self.status_code = status_code
+
+
+def get_readability_js(path=None):
+    if path is not None:
+        return Path(path).read_text(encoding="utf-8")
 
-def get_readability_js():
     session = CachedSession("py_request_cache", backend="filesystem", use_temp=True)
     js_code = []
 
@@ -78,51 +134,38 @@ def url_arg_handler(url):
         return url
 
 
-def main():
-    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+def check_page_text(cleaned_html):
+    soup = bs4.BeautifulSoup(cleaned_html, 'lxml')
+    soup_text = soup.body.text if soup.body else ""
 
-    parser = argparse.ArgumentParser()
-    parser.add_argument("url", help="Input URL or path")
-    parser.add_argument("output", help="Output dir")
-    parser.add_argument("--no-readability-js", action="store_true", help="Disable readability.js")
-    args = parser.parse_args()
+    try:
+        lang = langdetect.detect(soup_text)
+    except langdetect.lang_detect_exception.LangDetectException:
+        lang = "UNKNOWN"
 
-    access_url = url_arg_handler(args.url)
+    if not lang.lower().startswith("en"):
+        raise CrawlError(f"Content language {lang} isn't English")
 
-    if access_url is None:
-        logging.error("URL failed pre-tests. Exiting...")
-        sys.exit(-1)
+    if re.search(r"(data|privacy)\s*(?:policy|notice)", soup_text, re.I) is None:
+        raise CrawlError("Not like a privacy policy")
+
+
+async def launch_browser(playwright):
+    # Firefox generates simpler accessibility tree than chromium
+    # Tested on Debian's firefox-esr 91.5.0esr-1~deb11u1
+    return await playwright.firefox.launch(firefox_user_prefs=FIREFOX_CONFIGS)
 
-    firefox_configs = {
-        # Bypass CSP so we can always inject scripts
-        "security.csp.enable": False,
-        # Allow insecure TLS versions
-        "security.tls.version.min": 1,
-        "security.tls.version.enable-deprecated": True,
-        # Prevent some background traffic
-        "dom.serviceWorkers.enabled": False,
-        "network.websocket.max-connections": 0,
-        "media.autoplay.default": 5,
-        "media.peerconnection.enabled": False,
-        "privacy.trackingprotection.enabled": True,
-        "privacy.trackingprotection.lower_network_priority": True,
-        "privacy.trackingprotection.socialtracking.enabled": True,
-    }
 
-    with sync_playwright() as p:
-        # Firefox generates simpler accessibility tree than chromium
-        # Tested on Debian's firefox-esr 91.5.0esr-1~deb11u1
-        browser = p.firefox.launch(firefox_user_prefs=firefox_configs)
-        context = browser.new_context(bypass_csp=True)
+async def crawl_page(browser, access_url, output_dir, readability_js, no_readability_js=False):
+    """Load a page in a new browser context and save its cleaned HTML and accessibility tree to `output_dir`.
 
-        def error_cleanup(msg):
-            logging.error(msg)
-            context.close()
-            browser.close()
-            sys.exit(-1)
+    Raises CrawlError if the page fails any check.
+    """
+    context = await browser.new_context(bypass_csp=True)
 
-        page = context.new_page()
-        page.set_viewport_size({"width": 1080, "height": 1920})
+    try:
+        page = await context.new_page()
+        await page.set_viewport_size({"width": 1080, "height": 1920})
         logging.info("Navigating to %r", access_url)
 
         # Record HTTP status and navigated URLs so we can check errors later
@@ -131,79 +174,79 @@ def main():
         page.on("response", lambda r: url_status.update({r.url: r.status}))
         page.on("framenavigated", lambda f: f.parent_frame is None and navigated_urls.append(f.url))
 
-        page.goto(access_url)
+        await page.goto(access_url)
 
         try:
-            page.wait_for_load_state("networkidle")
+            await page.wait_for_load_state("networkidle")
         except PlaywrightTimeoutError:
             logging.warning("Cannot reach networkidle but will continue")
 
         # Check HTTP errors
         for url in navigated_urls:
             if (status_code := url_status.get(url, 0)) >= 400:
-                error_cleanup(f"Got HTTP error {status_code}")
+                raise HTTPStatusError(status_code)
 
         # Apply readability.js
-        page.evaluate("window.stop()")
-        page.add_script_tag(content=get_readability_js())
-        readability_info = page.evaluate(r"""(no_readability_js) => {
-            window.stop();
+        await page.evaluate("window.stop()")
+        await page.add_script_tag(content=readability_js)
+        readability_info = await page.evaluate(APPLY_READABILITY_JS, [no_readability_js])
+        cleaned_html = await page.content()
 
-            const documentClone = document.cloneNode(true);
-            const article = new Readability(documentClone).parse();
-            if (article !== null) article.applied = false;
+        # Check language (off the event loop, as it is CPU-bound)
+        await asyncio.to_thread(check_page_text, cleaned_html)
 
-            document.querySelectorAll('[aria-hidden=true]').forEach((x) => x.setAttribute("aria-hidden", false));
+        # obtain the accessibility tree
+        snapshot = await page.accessibility.snapshot(interesting_only=False)
+    finally:
+        await context.close()
 
-            if (isProbablyReaderable(document) && !no_readability_js) {
-                documentClone.body.innerHTML = article.content;
+    output_dir = Path(output_dir)
+    output_dir.mkdir(exist_ok=True)
 
-                if (documentClone.body.innerText.search(/(data|privacy|cookie)\s*(policy|notice)/) >= 0) {
-                    document.body.innerHTML = article.content;
-                    article.applied = true;
-                }
-            }
+    with open(output_dir / "accessibility_tree.json", "w", encoding="utf-8") as fout:
+        json.dump(snapshot, fout)
 
-            for (const elem of document.querySelectorAll('script, link, style, header, footer, nav'))
-                elem.remove();
+    with open(output_dir / "cleaned.html", "w", encoding="utf-8") as fout:
+        fout.write(cleaned_html)
 
-            return article;
-        }""", [args.no_readability_js])
-        cleaned_html = page.content()
+    with open(output_dir / "readability.json", "w", encoding="utf-8") as fout:
+        json.dump(readability_info, fout)
 
-        # Check language
-        soup = bs4.BeautifulSoup(cleaned_html, 'lxml')
-        soup_text = soup.body.text if soup.body else ""
+    logging.info("Saved to %s", output_dir)
 
-        try:
-            lang = langdetect.detect(soup_text)
-        except langdetect.lang_detect_exception.LangDetectException:
-            lang = "UNKNOWN"
 
-        if not lang.lower().startswith("en"):
-            error_cleanup(f"Content language {lang} isn't English")
+async def crawl_single_page(access_url, output_dir, readability_js, no_readability_js):
+    async with async_playwright() as p:
+        browser = await launch_browser(p)
 
-        if re.search(r"(data|privacy)\s*(?:policy|notice)", soup_text, re.I) is None:
-            error_cleanup("Not like a privacy policy")
+        try:
+            await crawl_page(browser, access_url, output_dir, readability_js, no_readability_js)
+        finally:
+            await browser.close()
 
-        # obtain the accessibility tree
-        snapshot = page.accessibility.snapshot(interesting_only=False)
 
-        output_dir = Path(args.output)
-        output_dir.mkdir(exist_ok=True)
+def main():
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
 
-        with open(output_dir / "accessibility_tree.json", "w", encoding="utf-8") as fout:
-            json.dump(snapshot, fout)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url", help="Input URL or path")
+    parser.add_argument("output", help="Output dir")
+    parser.add_argument("--readability-js", help="Local copy of readability.js (default: download)")
+    parser.add_argument("--no-readability-js", action="store_true", help="Disable readability.js")
+    args = parser.parse_args()
 
-        with open(output_dir / "cleaned.html", "w", encoding="utf-8") as fout:
-            fout.write(cleaned_html)
+    access_url = url_arg_handler(args.url)
 
-        with open(output_dir / "readability.json", "w", encoding="utf-8") as fout:
-            json.dump(readability_info, fout)
+    if access_url is None:
+        logging.error("URL failed pre-tests. Exiting...")
+        sys.exit(-1)
 
-        logging.info("Saved to %s", output_dir)
-        context.close()
-        browser.close()
+    try:
+        asyncio.run(crawl_single_page(access_url, args.output, get_readability_js(args.readability_js),
+                                       args.no_readability_js))
+    except CrawlError as e:
+        logging.error("%s", e)
+        sys.exit(-1)
 
 
 if __name__ == "__main__":
@@ -4,12 +4,18 @@ import argparse
 import hashlib
 import json
 import os
+import pickle
 import sqlite3
+import zlib
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 import tqdm
 from poligrapher.graph_utils import KGraph
 
+# Bump this whenever the cached form of graphs changes
+GRAPH_CACHE_VERSION = 1
+
 POLIGRAPH_DATA_MAPPING = {
     'email address': 'EmailAddress',
 
@@ -47,10 +53,42 @@ POLIGRAPH_DATA_MAPPING = {
 }
 
 
+def parse_graph(graph_path):
+    """Parse a PoliGraph and return its collection statements in the cached (compressed pickle) form.
+
+    Statements are kept as {datatype: [(entity, [purposes...]), ...]} for all datatypes, so that the cache does not
+    depend on POLIGRAPH_DATA_MAPPING.
+    """
+    graph = KGraph(graph_path)
+    collections = {}
+
+    for dt in graph.datatypes:
+        collections[dt] = [(entity, list(graph.purposes(entity, dt))) for entity in graph.who_collect(dt)]
+
+    return zlib.compress(pickle.dumps(collections, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def open_graph_cache(path):
+    con = sqlite3.connect(path)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('''CREATE TABLE IF NOT EXISTS poligraph_cache (
+        pp_hash TEXT PRIMARY KEY,
+        mtime_ns INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        version INTEGER NOT NULL,
+        collections BLOB NOT NULL
+    ) STRICT''')
+    con.commit()
+
+    return con
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("rootdir")
     parser.add_argument("privacy_policy_dir")
+    parser.add_argument("--nproc", type=int, help="Number of processes")
+    parser.add_argument("--graph_cache", help="Cache of parsed graphs (default: <rootdir>.poligraph_cache.db)")
     args = parser.parse_args()
 
     con = sqlite3.connect(args.rootdir.rstrip('/') + '.db')
@@ -75,10 +113,23 @@ def main():
     for domain, url in cur:
         url_to_domains[url].add(domain)
 
+    # Identical policies only have a graph in the folder of their canonical URL (see dedupe-policies.py)
+    canonical_urls = {}
+
+    if con.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'privacy_policy_dedup'").fetchone():
+        canonical_urls = dict(con.execute('SELECT url, canonical_url FROM privacy_policy_dedup'))
+
+    cache_con = open_graph_cache(args.graph_cache or args.rootdir.rstrip('/') + '.poligraph_cache.db')
+    cur = cache_con.execute('SELECT pp_hash, mtime_ns, size, collections FROM poligraph_cache WHERE version = ?',
+                            (GRAPH_CACHE_VERSION,))
+    graph_cache = {pp_hash: ((mtime_ns, size), blob) for pp_hash, mtime_ns, size, blob in cur}
+
     domains_with_pp = set()
-    domains_with_disclosures = set()
+    url_graphs = {}
+    graph_collections = {}
+    parse_tasks = {}
 
-    for url in tqdm.tqdm(sorted(url_to_domains.keys())):
+    for url in sorted(url_to_domains.keys()):
         url_black2s = hashlib.blake2s(url.encode()).hexdigest()
         pp_dir = os.path.join(args.privacy_policy_dir, url_black2s)
 
@@ -87,28 +138,65 @@ def main():
 
         domains_with_pp.update(url_to_domains[url])
 
-        graph = KGraph(os.path.join(pp_dir, 'graph-extended.full.yml'))
+        graph_hash = hashlib.blake2s(canonical_urls.get(url, url).encode()).hexdigest()
+        url_graphs[url] = graph_hash
 
+        if graph_hash in graph_collections or graph_hash in parse_tasks:
+            continue
+
+        # A cached graph is valid as long as the graph file is unchanged
+        graph_path = os.path.join(args.privacy_policy_dir, graph_hash, 'graph-extended.full.yml')
+        stat = os.stat(graph_path)
+        file_key = (stat.st_mtime_ns, stat.st_size)
+
+        if (entry := graph_cache.get(graph_hash)) is not None and entry[0] == file_key:
+            graph_collections[graph_hash] = entry[1]
+        else:
+            parse_tasks[graph_hash] = (graph_path, file_key)
+
+    del graph_cache
+    print(f"Graphs cached: {len(graph_collections)}, to parse: {len(parse_tasks)}")
+
+    with ProcessPoolExecutor(args.nproc) as executor:
+        results = executor.map(parse_graph, [t[0] for t in parse_tasks.values()], chunksize=16)
+
+        for blob, (graph_hash, (_, file_key)) in zip(results, tqdm.tqdm(parse_tasks.items())):
+            graph_collections[graph_hash] = blob
+            cache_con.execute('INSERT OR REPLACE INTO poligraph_cache VALUES (?, ?, ?, ?, ?)',
+                              (graph_hash, *file_key, GRAPH_CACHE_VERSION, blob))
+            cache_con.commit()
+
+    cache_con.close()
+
+    graph_disclosures = {}
+
+    for graph_hash, blob in graph_collections.items():
+        collections = pickle.loads(zlib.decompress(blob))
         disclosures = {}
 
-        for dt in graph.datatypes:
+        for dt, statements in collections.items():
             mapped_dt = POLIGRAPH_DATA_MAPPING.get(dt.split('@')[0].strip())
 
             if mapped_dt is not None:
                 disclosures.setdefault(mapped_dt, set())
 
-                for entity in graph.who_collect(dt):
-                    purposes = graph.purposes(entity, dt)
+                for _, purposes in statements:
                     disclosures[mapped_dt].update(purposes)
 
-        if len(disclosures) == 0:
-            continue
+        if len(disclosures) > 0:
+            graph_disclosures[graph_hash] = json.dumps({k: list(v) for k, v in disclosures.items()}, sort_keys=True)
+
+    domains_with_disclosures = set()
+    rows = []
 
-        domains_with_disclosures.update(url_to_domains[url])
+    for url, graph_hash in url_graphs.items():
+        if (disclosures_json := graph_disclosures.get(graph_hash)) is not None:
+            domains_with_disclosures.update(url_to_domains[url])
+            rows.append((url, disclosures_json))
 
-        con.execute('INSERT INTO privacy_policy_disclosures VALUES (?, json(?))',
-                    (url, json.dumps({k: list(v) for k, v in disclosures.items()}, sort_keys=True)))
-        con.commit()
+    con.executemany('INSERT INTO privacy_policy_disclosures VALUES (?, json(?))', rows)
+    con.commit()
+    con.close()
 
     print("Domains with privacy policies downloaded:", len(domains_with_pp))
     print("Domains with disclosures:", len(domains_with_disclosures))
@@ -0,0 +1,69 @@
+import numpy as np
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.linear_model import LogisticRegression
+
+NGRAM_RANGE = (2, 4)
+N_HASH_FEATURES = 1 << 18
+
+
+def get_vectorizer():
+    return HashingVectorizer(analyzer='char_wb', ngram_range=NGRAM_RANGE, n_features=N_HASH_FEATURES,
+                             alternate_sign=False, lowercase=True)
+
+
+class LinkPrefilter:
+    """Linear model over hashed character n-grams that screens out link features with no chance of reaching the
+    similarity threshold, so that they do not need to be embedded.
+
+    The decision threshold is calibrated on held-out texts so that a given fraction (the target recall) of texts
+    whose similarity reaches the threshold are kept.
+    """
+
+    def __init__(self, weights, bias, threshold):
+        self.vectorizer = get_vectorizer()
+        self.weights = weights
+        self.bias = bias
+        self.threshold = threshold
+
+    def decision_function(self, texts):
+        return self.vectorizer.transform(texts) @ self.weights + self.bias
+
+    def needs_embedding(self, texts):
+        """Boolean mask of texts to embed."""
+        return self.decision_function(texts) >= self.threshold
+
+    @classmethod
+    def train(cls, texts, labels, target_recall=0.999, holdout_fraction=0.2, seed=0):
+        """Train on texts labeled by whether their similarity reaches the threshold.
+
+        Returns the prefilter and its recall and pass rate (fraction of texts kept) on the held-out texts.
+        """
+        texts = np.asarray(texts, dtype=object)
+        labels = np.asarray(labels, dtype=bool)
+
+        rng = np.random.default_rng(seed)
+        is_holdout = rng.random(len(texts)) < holdout_fraction
+
+        classifier = LogisticRegression(class_weight='balanced', max_iter=1000)
+        classifier.fit(get_vectorizer().transform(texts[~is_holdout]), labels[~is_holdout])
+
+        prefilter = cls(classifier.coef_[0], classifier.intercept_[0], 0.0)
+
+        # Lowest threshold that keeps at least `target_recall` of held-out positives
+        holdout_scores = prefilter.decision_function(texts[is_holdout])
+        positive_scores = np.sort(holdout_scores[labels[is_holdout]])
+        n_missable = int(np.floor(len(positive_scores) * (1 - target_recall)))
+        prefilter.threshold = positive_scores[n_missable] if len(positive_scores) else np.inf
+
+        kept = holdout_scores >= prefilter.threshold
+        recall = kept[labels[is_holdout]].mean() if len(positive_scores) else float('nan')
+
+        return prefilter, recall, kept.mean()
+
+    def save(self, path):
+        np.savez(path, weights=self.weights, bias=self.bias, threshold=self.threshold)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['weights'], float(data['bias']), float(data['threshold']))
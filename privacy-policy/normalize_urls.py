@@ -1,10 +1,31 @@
 #!/usr/bin/env python3
 
 import argparse
+import os
 import sqlite3
+import sys
 from collections import Counter
 
-from whatwg_url import parse_url
+sys.path.insert(0, os.path.join(sys.path[0], '..', 'pylib'))
+from urlutil import parse_url  # pylint: disable=wrong-import-position
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def split_url(url):
+    """Parse a URL into (hostname, scheme, port, base, path, query, fragment).
+
+    `base` is the serialized URL up to the path, i.e., scheme and authority.
+    """
+    parsed = parse_url(url)
+    href = parsed.href
+    path, query, fragment = parsed.path, parsed.query, parsed.fragment
+
+    tail_length = len(path)
+    tail_length += len(query) + 1 if query is not None else 0
+    tail_length += len(fragment) + 1 if fragment is not None else 0
+
+    return parsed.hostname, parsed.scheme, parsed.port, href[:len(href) - tail_length], path, query, fragment
 
 
 def main():
@@ -19,50 +40,60 @@ def main():
 
     # Step 1: domain -> HTTP / HTTPs
     scheme_map = {}
-    norm_map = {}
+    url_components = []
 
     for url in all_urls:
-        parsed = parse_url(url)
+        components = split_url(url)
+        hostname, scheme = components[:2]
 
         # Prefer HTTPs
-        if scheme_map.get(parsed.hostname) != 'https':
-            scheme_map[parsed.hostname] = parsed.scheme
+        if scheme_map.get(hostname) != 'https':
+            scheme_map[hostname] = scheme
 
-    for url in all_urls:
-        parsed = parse_url(url)
-        parsed.scheme = scheme_map[parsed.hostname]
-        norm_map[url] = parsed.href
+        url_components.append(components)
 
-    # Step 2: Try to strip (1) fragment; (2) query; (3) trailing / in the path
-    component_to_strip = ['fragment', 'query', 'path']
+    # Each URL with the preferred scheme, then with (1) fragment; (2) query; (3) trailing / in the path stripped
+    url_forms = []
 
-    for i in range(len(component_to_strip)):
-        prefix_counter = Counter()
-        prefix_map = {}
+    for hostname, scheme, port, base, path, query, fragment in url_components:
+        new_scheme = scheme_map[hostname]
+        base = new_scheme + base[len(scheme):]
+
+        # Same as whatwg_url: changing the scheme drops a port that is the new scheme's default
+        if port is not None and port == DEFAULT_PORTS.get(new_scheme):
+            base = base.removesuffix(f':{port}')
+
+        no_query = base + path
+        no_fragment = no_query if query is None else f'{no_query}?{query}'
+        full = no_fragment if fragment is None else f'{no_fragment}#{fragment}'
+        no_trailing_slash = base + (path.rstrip('/') or '/')
 
-        for url in frozenset(norm_map.values()):
-            parsed = parse_url(url)
+        url_forms.append((full, no_fragment, no_query, no_trailing_slash))
 
-            for component in component_to_strip[:i + 1]:
-                setattr(parsed, component, parsed.path.rstrip('/') if component == 'path' else None)
+    del url_components
 
-            norm_url = parsed.href
+    norm_urls = [forms[0] for forms in url_forms]
+
+    # Step 2: Try to strip (1) fragment; (2) query; (3) trailing / in the path
+    # Stripping is applied cumulatively, so each normalized URL strips to the same form as its original URL
+    for level in range(1, 4):
+        prefix_map = {}
 
-            prefix_counter[norm_url] += 1
-            prefix_map[url] = norm_url
+        for norm_url, forms in zip(norm_urls, url_forms):
+            prefix_map[norm_url] = forms[level]
 
-        for url in all_urls:
-            norm_url = prefix_map[norm_map[url]]
+        prefix_counter = Counter(prefix_map.values())
 
-            if prefix_counter[norm_url] > 1:
-                norm_map[url] = norm_url
+        for i, forms in enumerate(url_forms):
+            if prefix_counter[forms[level]] > 1:
+                norm_urls[i] = forms[level]
 
     con.execute('DROP TABLE IF EXISTS privacy_policy_link_normalized')
     con.execute('''CREATE TABLE privacy_policy_link_normalized (
         url TEXT UNIQUE NOT NULL,
         normalized_url TEXT NOT NULL
     ) STRICT''')
-    con.executemany('INSERT INTO privacy_policy_link_normalized VALUES (?, ?)', norm_map.items())
+    con.executemany('INSERT INTO privacy_policy_link_normalized VALUES (?, ?)', zip(all_urls, norm_urls))
     con.commit()
 
 
@@ -0,0 +1,91 @@
+import sqlite3
+from collections import OrderedDict
+
+# SQLite limits the number of host parameters in one statement
+MAX_QUERY_PARAMS = 900
+
+
+class SimilarityCache:
+    """Persistent cache of link text similarity scores, keyed by model name and text.
+
+    Scores are stored in an SQLite database (in WAL mode, so that several GPU workers can share it) and the most
+    recently used ones are also kept in a bounded in-memory LRU dict.
+    """
+
+    def __init__(self, path, model_name, max_memory_items=1_000_000):
+        self.model_name = model_name
+        self.max_memory_items = max_memory_items
+        self.memory = OrderedDict()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.con = sqlite3.connect(path, timeout=60)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('''CREATE TABLE IF NOT EXISTS text_similarity (
+            model TEXT NOT NULL,
+            text TEXT NOT NULL,
+            score REAL NOT NULL,
+            PRIMARY KEY(model, text)
+        ) STRICT, WITHOUT ROWID''')
+        self.con.commit()
+
+    def _remember(self, text, score):
+        self.memory[text] = score
+        self.memory.move_to_end(text)
+
+        if len(self.memory) > self.max_memory_items:
+            self.memory.popitem(last=False)
+
+    def get_many(self, texts):
+        """Return a dict of cached scores for the given unique texts. Texts not in the cache are left out."""
+        results = {}
+        disk_texts = []
+
+        for text in texts:
+            if (score := self.memory.get(text)) is not None:
+                self.memory.move_to_end(text)
+                results[text] = score
+            else:
+                disk_texts.append(text)
+
+        self.memory_hits += len(results)
+
+        for i in range(0, len(disk_texts), MAX_QUERY_PARAMS):
+            chunk = disk_texts[i:i + MAX_QUERY_PARAMS]
+            cur = self.con.execute(f'''
+                SELECT text, score FROM text_similarity
+                WHERE model = ? AND text IN ({", ".join("?" * len(chunk))})
+            ''', (self.model_name, *chunk))
+
+            for text, score in cur:
+                results[text] = score
+                self._remember(text, score)
+                self.disk_hits += 1
+
+        self.misses += len(texts) - len(results)
+
+        return results
+
+    def put_many(self, scores):
+        """Store a dict of text -> score."""
+        self.con.executemany('INSERT OR IGNORE INTO text_similarity VALUES (?, ?, ?)',
+                             ((self.model_name, text, float(score)) for text, score in scores.items()))
+        self.con.commit()
+
+        for text, score in scores.items():
+            self._remember(text, float(score))
+
+    @property
+    def hit_rate(self):
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': self.hit_rate,
+        }
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import argparse
+import sqlite3
+
+from link_prefilter import LinkPrefilter
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rootdir")
+    parser.add_argument("--model", default='sentence-transformers/all-MiniLM-L6-v2')
+    parser.add_argument("--similarity_cache",
+                        help="Similarity cache filled by extract-links.py (default: <rootdir>.similarity_cache.db)")
+    parser.add_argument("--output", help="Output path (default: <rootdir>.link_prefilter.npz)")
+    parser.add_argument("--match_threshold", type=float, default=0.75)
+    parser.add_argument("--target_recall", type=float, default=0.999,
+                        help="Fraction of held-out texts reaching the match threshold that must pass the prefilter")
+    args = parser.parse_args()
+
+    cache_path = args.similarity_cache or args.rootdir.rstrip('/') + '.similarity_cache.db'
+    output_path = args.output or args.rootdir.rstrip('/') + '.link_prefilter.npz'
+
+    # Scores in the cache are the output of full embedding, which the prefilter has to agree with
+    con = sqlite3.connect(cache_path)
+    cur = con.execute('SELECT text, score FROM text_similarity WHERE model = ?', (args.model,))
+    texts, scores = zip(*cur.fetchall())
+    con.close()
+
+    labels = [s >= args.match_threshold for s in scores]
+    print(f"Training on {len(texts)} texts, {sum(labels)} reaching the match threshold")
+
+    prefilter, recall, pass_rate = LinkPrefilter.train(texts, labels, target_recall=args.target_recall)
+    print(f"Held-out recall: {recall:.4f}, texts to embed: {pass_rate:.2%}")
+
+    prefilter.save(output_path)
+
+
+if __name__ == '__main__':
+    main()
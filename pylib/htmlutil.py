@@ -1,4 +1,7 @@
-from bs4 import BeautifulSoup, Comment
+import regex
+from bs4 import BeautifulSoup, Comment, Tag
+from bs4.dammit import EncodingDetector
+from lxml import etree
 
 
 def remove_trivial_attributes(soup):
@@ -52,29 +55,252 @@ def cleanup_list_options(soup, n_options=5):
             options[n_options - 1].string = '...'
 
 
+CLEANUP_FUNCTIONS = [
+    remove_trivial_elements,
+    remove_long_attributes,
+    remove_empty_tags,
+    remove_trivial_attributes,
+    keep_minimal_attributes,
+    remove_comments,
+    cleanup_list_options,
+]
+
+
+def _format_start_tag(tag, formatter):
+    """Format the opening tag of a non-empty `tag` the way `tag.decode()` does."""
+    attrs = []
+
+    for key, val in formatter.attributes(tag):
+        if val is None:
+            attrs.append(key)
+            continue
+
+        if isinstance(val, (list, tuple)):
+            val = ' '.join(val)
+        elif not isinstance(val, str):
+            val = str(val)
+
+        attrs.append(f'{key}={formatter.quoted_attribute_value(formatter.attribute_value(val))}')
+
+    prefix = tag.prefix + ':' if tag.prefix else ''
+
+    return '<' + prefix + tag.name + ''.join(' ' + a for a in attrs) + '>'
+
+
+def iter_prettify_lines(soup, formatter='minimal'):
+    """Yield the lines of `soup.prettify()`, each with its line break, without formatting the whole document.
+
+    Joined together, the lines are exactly `soup.prettify()`. Like prettify(), elements whose whitespace must be
+    preserved (<pre>, <textarea>) are not pretty-printed, so each of them makes up a single "line".
+    """
+    formatter = soup.formatter_for_name(formatter)
+    stack = [(child, 0, False) for child in reversed(soup.contents)]
+
+    while stack:
+        node, depth, closing = stack.pop()
+        indent = formatter.indent * depth
+
+        if closing:
+            prefix = node.prefix + ':' if node.prefix else ''
+            yield indent + '</' + prefix + node.name + '>\n'
+        elif isinstance(node, Tag):
+            # Empty elements and elements whose whitespace is preserved are formatted as a whole
+            if node.is_empty_element or node.name in (node.preserve_whitespace_tags or ()):
+                yield indent + node.decode(formatter=formatter) + '\n'
+            else:
+                yield indent + _format_start_tag(node, formatter) + '\n'
+                stack.append((node, depth, True))
+                stack.extend((child, depth + 1, False) for child in reversed(node.contents))
+        elif text := node.output_ready(formatter).strip():
+            yield indent + text + '\n'
+
+
+def count_prettify_tokens(soup, tokenizer, cache):
+    """Count the tokens of `soup.prettify()` line by line, reusing counts of lines seen before.
+
+    tiktoken splits text with a regex before encoding each piece, so the sum is exact as long as that regex also
+    splits the text at every line boundary. Lines that the regex would not split are counted together instead.
+    Returns None if the tokenizer does not expose its regex.
+    """
+    if (pat_str := getattr(tokenizer, '_pat_str', None)) is None:
+        return None
+
+    pattern = regex.compile(pat_str)
+
+    def count_text(text):
+        # Token count and last regex piece of `text`
+        if (entry := cache.get(text)) is None:
+            entry = cache[text] = (len(tokenizer.encode(text)), pattern.findall(text)[-1])
+
+        return entry
+
+    n_tokens = 0
+    pending = last_piece = ''
+
+    for line in iter_prettify_lines(soup):
+        if pending:
+            # Whether the last piece of `pending` is still a piece of its own once `line` follows
+            if (split := cache.get((last_piece, line))) is None:
+                split = cache[last_piece, line] = pattern.match(last_piece + line).end() == len(last_piece)
+
+            if not split:
+                pending += line
+                last_piece = pattern.findall(last_piece + line)[-1]
+                continue
+
+            n_tokens += count_text(pending)[0]
+
+        pending = line
+        last_piece = count_text(line)[1]
+
+    return n_tokens + (count_text(pending)[0] if pending else 0)
+
+
 def cleanup_html(html_code, tokenizer, target_length=512):
+    """Apply as few cleanup functions as needed to bring the prettified HTML within `target_length` tokens.
+
+    Token counts of the cleanup levels come from `count_prettify_tokens()`, so the prettified HTML is only serialized
+    and tokenized as a whole for the first level that fits (or the last level).
+    """
     soup = BeautifulSoup(html_code, 'html.parser')
+    cache = {}
+
+    for level in range(len(CLEANUP_FUNCTIONS) + 1):
+        if level > 0:
+            CLEANUP_FUNCTIONS[level - 1](soup)
+
+        if level < len(CLEANUP_FUNCTIONS):
+            n_tokens = count_prettify_tokens(soup, tokenizer, cache)
+
+            if n_tokens is not None and n_tokens > target_length:
+                continue
 
-    cleanup_functions = [
-        remove_trivial_elements,
-        remove_long_attributes,
-        remove_empty_tags,
-        remove_trivial_attributes,
-        keep_minimal_attributes,
-        remove_comments,
-        cleanup_list_options,
-    ]
-
-    for func in cleanup_functions:
         cleaned_code = str(soup.prettify())
         n_tokens = len(tokenizer.encode(cleaned_code))
 
         if n_tokens <= target_length:
             break
 
-        func(soup)
+    return cleaned_code, n_tokens
+
+
+class _AnchorCollector:
+    """lxml parser target that collects the text and href of <a href> elements without building a tree.
+
+    Texts are the same as `a.get_text()` in BeautifulSoup with the lxml builder: whitespace-only strings outside
+    <pre> and <textarea> are collapsed to a space or a newline, and strings in script, style, template and ruby
+    annotation elements (as well as comments, etc.) are left out.
+    """
+
+    EXCLUDED_STRING_TAGS = frozenset(['script', 'style', 'template', 'rt', 'rp'])
+    PRESERVE_WHITESPACE_TAGS = frozenset(['pre', 'textarea'])
+    ASCII_SPACES = frozenset('\x20\x0a\x09\x0c\x0d')
+
+    def __init__(self):
+        self.anchors = []
+        self.open_tags = []  # (tag, index in self.anchors or None)
+        self.open_anchors = []
+        self.excluded_depth = 0
+        self.preserve_whitespace_depth = 0
+        self.current_data = []
+
+    def _end_data(self):
+        if not self.current_data:
+            return
+
+        string = ''.join(self.current_data)
+        self.current_data.clear()
+
+        if self.excluded_depth or not self.open_anchors:
+            return
+
+        if self.preserve_whitespace_depth == 0 and all(c in self.ASCII_SPACES for c in string):
+            string = '\n' if '\n' in string else ' '
+
+        for idx in self.open_anchors:
+            self.anchors[idx][0].append(string)
+
+    def _pop_tag(self):
+        tag, anchor_idx = self.open_tags.pop()
+
+        if tag in self.EXCLUDED_STRING_TAGS:
+            self.excluded_depth -= 1
+        elif tag in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace_depth -= 1
+
+        if anchor_idx is not None:
+            self.open_anchors.pop()
+            texts, href = self.anchors[anchor_idx]
+            self.anchors[anchor_idx] = (''.join(texts).strip(), href)
+
+        return tag
+
+    def start(self, tag, attrib, *_):
+        self._end_data()
+        anchor_idx = None
+
+        if tag in self.EXCLUDED_STRING_TAGS:
+            self.excluded_depth += 1
+        elif tag in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace_depth += 1
+        elif tag == 'a' and (href := attrib.get('href')) is not None:
+            anchor_idx = len(self.anchors)
+            self.open_anchors.append(anchor_idx)
+            self.anchors.append(([], href))
+
+        self.open_tags.append((tag, anchor_idx))
+
+    def end(self, tag):
+        self._end_data()
+
+        if any(t == tag for t, _ in self.open_tags):
+            while self._pop_tag() != tag:
+                pass
+
+    def data(self, data):
+        self.current_data.append(data)
+
+    def comment(self, _):
+        self._end_data()
+
+    def pi(self, *_):
+        self._end_data()
+
+    def doctype(self, *_):
+        self._end_data()
+
+    def close(self):
+        self._end_data()
+
+        while self.open_tags:
+            self._pop_tag()
+
+        return self.anchors
+
+
+def extract_anchors(markup, chunk_size=1 << 16):
+    """Return `(anchors, encoding)`: (text, href) pairs of <a href> elements in document order, and the encoding
+    BeautifulSoup would report as `original_encoding` (None for str input).
+
+    The markup is fed to lxml in chunks and no tree is built, so memory use does not grow with the page size.
+    """
+    if isinstance(markup, str):
+        candidates = [(markup.removeprefix('\N{BYTE ORDER MARK}'), None)]
     else:
-        cleaned_code = str(soup.prettify())
-        n_tokens = len(tokenizer.encode(cleaned_code))
+        detector = EncodingDetector(markup, is_html=True)
+        candidates = [(detector.markup, encoding) for encoding in detector.encodings]
 
-    return cleaned_code, n_tokens
+    # Like BeautifulSoup, use the first encoding that lxml accepts
+    for data, encoding in candidates:
+        parser = etree.HTMLParser(target=_AnchorCollector(), strip_cdata=False, recover=True, encoding=encoding)
+
+        try:
+            # Feed at least once, as lxml rejects closing a parser that has seen no data
+            for i in range(0, max(len(data), 1), chunk_size):
+                parser.feed(data[i:i + chunk_size])
+
+            return parser.close(), encoding
+        except (UnicodeDecodeError, LookupError, etree.ParserError):
+            continue
+
+    return [], None
@@ -0,0 +1,335 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import time
+
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, OpenAIError, RateLimitError
+from openai.types.chat import ChatCompletion
+
+RETRYABLE_ERRORS = (RateLimitError, APIConnectionError, InternalServerError)
+
+
+class PerMinuteLimiter:
+    """Token bucket that allows `limit` units per minute, with bursts of up to `limit` units."""
+
+    def __init__(self, limit):
+        self.capacity = limit
+        self.rate = limit / 60.0
+        self.available = float(limit)
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+
+        # Holding the lock while waiting serves callers in FIFO order
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.last_update) * self.rate)
+                self.last_update = now
+
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+
+                await asyncio.sleep((amount - self.available) / self.rate)
+
+
+class ResponseCache:
+    """Persistent cache of chat completions, keyed by model name and a digest of the prompt.
+
+    The digest covers the messages and all other request parameters except `seed`, so that re-runs with another
+    seed reuse earlier answers to the same prompt. Only complete responses are cached, so that truncated or
+    malformed ones are requested again on the next run.
+    """
+
+    def __init__(self, path):
+        self.con = sqlite3.connect(path)
+        self.con.execute('''CREATE TABLE IF NOT EXISTS chat_completion_cache (
+            model TEXT NOT NULL,
+            prompt_digest TEXT NOT NULL,
+            response TEXT NOT NULL,
+            PRIMARY KEY(model, prompt_digest)
+        ) STRICT''')
+        self.con.commit()
+
+    @staticmethod
+    def get_key(kwargs):
+        request = {k: v for k, v in kwargs.items() if k not in ('model', 'seed')}
+        digest = hashlib.sha256(json.dumps(request, sort_keys=True).encode()).hexdigest()
+        return kwargs['model'], digest
+
+    @staticmethod
+    def is_complete(kwargs, response):
+        """Whether all choices finished normally and, in JSON mode, hold valid JSON."""
+        json_mode = (kwargs.get('response_format') or {}).get('type') == 'json_object'
+
+        for choice in response.choices:
+            if choice.finish_reason != 'stop':
+                return False
+
+            if json_mode:
+                try:
+                    json.loads(choice.message.content or '')
+                except ValueError:
+                    return False
+
+        return True
+
+    def get(self, key, kwargs):
+        row = self.con.execute('SELECT response FROM chat_completion_cache WHERE model = ? AND prompt_digest = ?',
+                               key).fetchone()
+
+        if row is None:
+            return None
+
+        # Entries written before incomplete responses were rejected are treated as misses, and replaced
+        response = ChatCompletion.model_validate_json(row[0])
+        return response if self.is_complete(kwargs, response) else None
+
+    def put(self, key, response):
+        self.con.execute('INSERT OR REPLACE INTO chat_completion_cache VALUES (?, ?, ?)',
+                         (*key, response.model_dump_json()))
+        self.con.commit()
+
+
+def add_engine_arguments(parser):
+    group = parser.add_argument_group("API options")
+    group.add_argument("--base-url",
+                       help="Base URL of an OpenAI-compatible API (default: $OPENAI_BASE_URL or OpenAI)")
+    group.add_argument("--concurrency", type=int, default=16, help="Maximum number of concurrent requests")
+    group.add_argument("--rpm", type=int, help="Requests-per-minute limit")
+    group.add_argument("--tpm", type=int, help="Tokens-per-minute limit (counting prompt tokens)")
+    group.add_argument("--max-retries", type=int, default=8,
+                       help="Retries on rate limit, connection and server errors")
+    group.add_argument("--llm-cache",
+                       help="SQLite file caching responses by prompt (default: <root_dir>.llm_cache.db)")
+    group.add_argument("--no-llm-cache", action="store_true", help="Always query the API")
+
+    group = parser.add_argument_group("Batch mode").add_mutually_exclusive_group()
+    group.add_argument("--batch-requests", metavar="PATH",
+                       help="Write all requests to a batch input JSONL file instead of calling the API")
+    group.add_argument("--batch-results", metavar="PATH",
+                       help="Read responses from a batch output JSONL file instead of calling the API")
+
+
+class ChatCompletionEngine:
+    """Run chat completion requests concurrently under request and token rate limits."""
+
+    def __init__(self, concurrency=16, rpm=None, tpm=None, max_retries=8, base_url=None, cache=None,
+                 max_backoff=60.0):
+        # Retries are handled here, so that they also go through the rate limiters
+        self.client = AsyncOpenAI(base_url=base_url, max_retries=0)
+        self.concurrency = concurrency
+        self.request_limiter = PerMinuteLimiter(rpm) if rpm else None
+        self.token_limiter = PerMinuteLimiter(tpm) if tpm else None
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+
+        self.cache = cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self._inflight = {}
+
+    @classmethod
+    def from_args(cls, args):
+        if args.no_llm_cache:
+            cache = None
+        else:
+            cache = ResponseCache(args.llm_cache or args.root_dir.rstrip('/') + '.llm_cache.db')
+
+        return cls(args.concurrency, args.rpm, args.tpm, args.max_retries, args.base_url, cache)
+
+    def get_retry_delay(self, error, attempt):
+        response = getattr(error, 'response', None)
+
+        try:
+            retry_after = float(response.headers['retry-after'])
+        except (AttributeError, KeyError, ValueError):
+            retry_after = None
+
+        if retry_after is not None and 0 < retry_after <= self.max_backoff:
+            return retry_after
+
+        # Exponential backoff with jitter, so that throttled requests do not retry in lockstep
+        return random.uniform(0.5, 1.0) * min(self.max_backoff, 2.0 ** attempt)
+
+    async def create(self, n_tokens, **kwargs):
+        """Call `chat.completions.create(**kwargs)`, charging `n_tokens` against the token limit.
+
+        Cached responses are returned without calling the API. Identical requests in flight share one API call.
+        Responses that are truncated (finish reason other than "stop") or not valid JSON in JSON mode are returned
+        but not cached.
+        """
+        if self.cache is None:
+            return await self._create(n_tokens, **kwargs)
+
+        cache_key = self.cache.get_key(kwargs)
+
+        if (response := self.cache.get(cache_key, kwargs)) is not None:
+            self.cache_hits += 1
+            return response
+
+        if cache_key in self._inflight:
+            self.cache_hits += 1
+            return await asyncio.shield(self._inflight[cache_key])
+
+        self.cache_misses += 1
+        self._inflight[cache_key] = future = asyncio.ensure_future(self._create(n_tokens, **kwargs))
+
+        try:
+            response = await asyncio.shield(future)
+        finally:
+            del self._inflight[cache_key]
+
+        if self.cache.is_complete(kwargs, response):
+            self.cache.put(cache_key, response)
+
+        return response
+
+    async def _create(self, n_tokens, **kwargs):
+        attempt = 0
+
+        while True:
+            if self.request_limiter:
+                await self.request_limiter.acquire()
+
+            if self.token_limiter:
+                await self.token_limiter.acquire(n_tokens)
+
+            try:
+                return await self.client.chat.completions.create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= self.max_retries:
+                    raise
+
+                delay = self.get_retry_delay(e, attempt)
+                logging.warning('%s, retrying in %.1fs', type(e).__name__, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _run(self, key, n_tokens, kwargs):
+        try:
+            return key, await self.create(n_tokens, **kwargs)
+        except OpenAIError as e:
+            logging.warning('Request %r failed: %r', key, e)
+            return key, None
+
+    async def map(self, requests):
+        """Run `(key, n_tokens, kwargs)` requests and yield `(key, response)` pairs in completion order.
+
+        `requests` is consumed lazily, only as fast as responses come back. The response is None if the request
+        failed with a non-retryable error or ran out of retries.
+        """
+        requests = iter(requests)
+        pending = set()
+
+        while True:
+            while len(pending) < self.concurrency and (request := next(requests, None)) is not None:
+                pending.add(asyncio.create_task(self._run(*request)))
+
+            if not pending:
+                break
+
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                yield task.result()
+
+        if self.cache is not None and (n_requests := self.cache_hits + self.cache_misses):
+            logging.info('Response cache: %d hits, %d misses (hit rate: %.1f%%)',
+                         self.cache_hits, self.cache_misses, 100 * self.cache_hits / n_requests)
+
+
+def resume_jsonl(path):
+    """Read records from an append-mode JSONL output file, dropping a partial last line of an interrupted run."""
+    records = []
+
+    if not os.path.exists(path):
+        return records
+
+    with open(path, 'rb+') as fin:
+        valid_size = 0
+
+        for line in fin:
+            if not line.endswith(b'\n'):
+                break
+
+            if line.strip():
+                records.append(json.loads(line))
+
+            valid_size += len(line)
+
+        fin.truncate(valid_size)
+
+    return records
+
+
+def encode_custom_id(key):
+    return '/'.join(key)
+
+
+def decode_custom_id(custom_id):
+    return tuple(custom_id.split('/'))
+
+
+def write_batch_requests(path, requests):
+    """Write `(key, n_tokens, kwargs)` requests to a JSONL file in the format of the OpenAI batch API."""
+    n_requests = 0
+
+    with open(path, 'w', encoding='utf-8') as fout:
+        for key, _, kwargs in requests:
+            print(json.dumps({
+                'custom_id': encode_custom_id(key),
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': kwargs,
+            }), file=fout)
+            n_requests += 1
+
+    logging.info('Wrote %d requests to %s', n_requests, path)
+
+
+def read_batch_results(path):
+    """Yield `(key, response)` pairs from an OpenAI batch output JSONL file. The response is None on errors."""
+    with open(path, encoding='utf-8') as fin:
+        for line in fin:
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+            key = decode_custom_id(record['custom_id'])
+            response = record.get('response') or {}
+
+            if record.get('error') or response.get('status_code') != 200:
+                logging.warning('Request %r failed: %r', key, record.get('error') or response.get('body'))
+                yield key, None
+            else:
+                yield key, ChatCompletion.model_validate(response['body'])
+
+
+def run_chat_completions(args, make_requests, handle_response):
+    """Call `handle_response(key, response)` for each request from `make_requests()`.
+
+    Requests are sent to the API with a ChatCompletionEngine, unless batch mode is selected: `--batch-requests`
+    only writes the requests to a file, and `--batch-results` reads the responses from a file without calling
+    `make_requests()`. Keys must be tuples of strings without slashes, e.g., (domain, job_hash, form_filename).
+    """
+    if args.batch_results:
+        for key, response in read_batch_results(args.batch_results):
+            handle_response(key, response)
+    elif args.batch_requests:
+        write_batch_requests(args.batch_requests, make_requests())
+    else:
+        engine = ChatCompletionEngine.from_args(args)
+
+        async def run():
+            async for key, response in engine.map(make_requests()):
+                handle_response(key, response)
+
+        asyncio.run(run())
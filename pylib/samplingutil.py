@@ -0,0 +1,75 @@
+import json
+from collections import defaultdict
+
+import numpy as np
+
+
+def weighted_permutation(weights, rng):
+    """Order items as successive weighted draws without replacement. Items with zero weight are left out."""
+    weights = np.asarray(weights, dtype=np.float64)
+
+    # Efraimidis-Spirakis: sorting exponential keys scaled by 1/weight
+    with np.errstate(divide='ignore'):
+        keys = rng.exponential(size=len(weights)) / weights
+
+    order = np.argsort(keys, kind='stable')
+    return order[np.isfinite(keys[order])]
+
+
+def stratified_sample(strata, n_per_stratum, rng, weights=None):
+    """Draw up to `n_per_stratum` items (weighted, without replacement) from each stratum.
+
+    Returns item indices grouped by stratum (in sorted order), each group in draw order.
+    """
+    strata = np.asarray(strata)
+    order = weighted_permutation(np.ones(len(strata)) if weights is None else weights, rng)
+    order = order[np.argsort(strata[order], kind='stable')]
+
+    sorted_strata = strata[order]
+    group_starts = np.flatnonzero(np.r_[True, sorted_strata[1:] != sorted_strata[:-1]])
+    group_sizes = np.diff(np.r_[group_starts, len(order)])
+    rank_in_group = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+
+    return order[rank_in_group < n_per_stratum]
+
+
+def sample_catalog_forms(con, rng, where='TRUE', params=(), min_domains_per_category=0):
+    """Order forms in the form catalog matching `where` as successive random draws.
+
+    Draws follow a hierarchy: a random content category, a random domain of that category, a random job of that
+    domain, and a random form of that job, rejecting forms that do not match `where`. Categories with at most
+    `min_domains_per_category` domains are merged into "Other".
+    """
+    category_domains = defaultdict(list)
+    domain_jobs = {}
+
+    for domain, n_jobs, categories_json in con.execute('SELECT domain, n_jobs, categories FROM form_catalog_domains'):
+        domain_jobs[domain] = n_jobs
+
+        for cat in json.loads(categories_json):
+            category_domains[cat].append(domain)
+
+    for cat in list(category_domains.keys()):
+        if len(category_domains[cat]) <= min_domains_per_category:
+            category_domains['Other'].extend(category_domains[cat])
+            del category_domains[cat]
+
+    # Probability of drawing each domain, up to a constant factor
+    domain_weight = defaultdict(float)
+
+    for domains in category_domains.values():
+        for domain in domains:
+            domain_weight[domain] += 1.0 / len(domains)
+
+    job_forms = dict(con.execute('SELECT job_hash, count(*) FROM form_catalog GROUP BY job_hash'))
+
+    descriptors = []
+    weights = []
+
+    for domain, job_hash, form_filename in con.execute(f'''
+        SELECT domain, job_hash, form_filename FROM form_catalog WHERE {where}
+    ''', params):
+        descriptors.append((domain, job_hash, form_filename))
+        weights.append(domain_weight[domain] / domain_jobs[domain] / job_forms[job_hash])
+
+    return [descriptors[i] for i in weighted_permutation(weights, rng)]
@@ -0,0 +1,142 @@
+"""Parity of `htmlutil.cleanup_html` with the original implementation, which prettified and tokenized every level.
+
+Run with `python -m pytest pylib/test_htmlutil.py` or `python pylib/test_htmlutil.py`. The tokenizers are small
+byte-level tiktoken encodings with the regexes of cl100k_base and gpt2, so no encoding files need to be downloaded.
+"""
+
+import random
+
+import tiktoken
+from bs4 import BeautifulSoup
+
+import htmlutil
+
+PAT_STRS = {
+    'cl100k': r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|"""
+              r"""\s+(?!\S)|\s+""",
+    'gpt2': r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""",
+}
+
+MERGES = [b'  ', b' <', b'</', b'\n ', b'>\n', b'="', b'div', b'span', b'input', b'option', b'class', b'pre']
+
+PRE_SPANS = '<pre>' + ''.join(f'<span class="k{i}">x{i}</span>' for i in range(60)) + '</pre>'
+
+SNIPPETS = [
+    PRE_SPANS,
+    '<pre>\n\n  x  <b> y </b>\n</pre>',
+    '<textarea>\n  a &lt; b\n  <b>c</b></textarea>',
+    '<textarea></textarea>',
+    '<pre><pre>nested</pre></pre>',
+    '<meta charset="latin1"><meta http-equiv="content-type" content="text/html; charset=latin1">',
+    '<span title=\'say "hi"\' data-x="a&amp;b" hidden>&nbsp;&lt;tag&gt; café </span>',
+    '<p>   </p><b></b>',
+    '<!-- a comment --><br/><hr>',
+    '<img src="/' + 'y' * 80 + '.png">',
+    '<script>var x = "' + 'a' * 200 + '";</script>',
+]
+
+
+def cleanup_html_reference(html_code, tokenizer, target_length=512):
+    """`cleanup_html` as it was before token counts were cached."""
+    soup = BeautifulSoup(html_code, 'html.parser')
+
+    for func in htmlutil.CLEANUP_FUNCTIONS:
+        cleaned_code = str(soup.prettify())
+        n_tokens = len(tokenizer.encode(cleaned_code))
+
+        if n_tokens <= target_length:
+            break
+
+        func(soup)
+    else:
+        cleaned_code = str(soup.prettify())
+        n_tokens = len(tokenizer.encode(cleaned_code))
+
+    return cleaned_code, n_tokens
+
+
+def make_tokenizer(name):
+    ranks = {bytes([i]): i for i in range(256)}
+
+    for token in MERGES:
+        ranks[token] = len(ranks)
+
+    return tiktoken.Encoding(name, pat_str=PAT_STRS[name], mergeable_ranks=ranks, special_tokens={})
+
+
+def make_form(rng):
+    parts = ['<form method="post" action="/submit" class="form very-long-class-name" style="color: red">']
+
+    for i in range(rng.randint(1, 12)):
+        parts.append(rng.choice([
+            f'<div class="row"><label for="f{i}">Field {i}</label><input type="text" name="f{i}" id="f{i}"></div>',
+            f'<select name="s{i}">' + ''.join(f'<option value="{j}">Option {j}</option>' for j in range(12))
+            + '</select>',
+            '<ul>' + ''.join(f'<li>item {j}</li>' for j in range(8)) + '</ul>',
+            f'<div><span></span><p>Some text {i} here</p></div>',
+            rng.choice(SNIPPETS),
+        ]))
+
+    parts.append('<input type="submit" value="Send"></form>')
+
+    return ''.join(parts)
+
+
+def make_documents():
+    rng = random.Random(0)
+    docs = [
+        '<form><input name="q">' + PRE_SPANS + '</form>',
+        '<form method="post"><input name="a" class="x y"><!-- c -->' + PRE_SPANS + '<select>'
+        + ''.join(f'<option>o{i}</option>' for i in range(20)) + '</select></form>',
+        ''.join(SNIPPETS),
+    ]
+    docs.extend(make_form(rng) for _ in range(8))
+
+    return docs
+
+
+def test_prettify_lines():
+    for html_code in make_documents():
+        soup = BeautifulSoup(html_code, 'html.parser')
+
+        for func in [None, *htmlutil.CLEANUP_FUNCTIONS]:
+            if func is not None:
+                func(soup)
+
+            assert ''.join(htmlutil.iter_prettify_lines(soup)) == soup.prettify()
+
+
+def test_count_prettify_tokens():
+    for name in PAT_STRS:
+        tokenizer = make_tokenizer(name)
+        cache = {}
+
+        for html_code in make_documents():
+            soup = BeautifulSoup(html_code, 'html.parser')
+
+            for func in [None, *htmlutil.CLEANUP_FUNCTIONS]:
+                if func is not None:
+                    func(soup)
+
+                assert htmlutil.count_prettify_tokens(soup, tokenizer, cache) == len(tokenizer.encode(soup.prettify()))
+
+
+def test_cleanup_html():
+    for name in PAT_STRS:
+        tokenizer = make_tokenizer(name)
+
+        for html_code in make_documents():
+            n_tokens = cleanup_html_reference(html_code, tokenizer, 0)[1]
+            full_tokens = len(tokenizer.encode(BeautifulSoup(html_code, 'html.parser').prettify()))
+            targets = {*range(0, full_tokens + 20, max(full_tokens // 20, 1)), n_tokens - 1, n_tokens, full_tokens}
+
+            for target_length in sorted(targets):
+                assert htmlutil.cleanup_html(html_code, tokenizer, target_length) == \
+                    cleanup_html_reference(html_code, tokenizer, target_length), (name, html_code, target_length)
+
+
+if __name__ == '__main__':
+    test_prettify_lines()
+    test_count_prettify_tokens()
+    test_cleanup_html()
+    print("OK")
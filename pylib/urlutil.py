@@ -0,0 +1,65 @@
+import functools
+
+import tldextract
+import whatwg_url
+
+# Use the public suffix list snapshot bundled with tldextract, so that it is loaded once without network access
+_tld_extractor = tldextract.TLDExtract(suffix_list_urls=(), cache_dir=None)
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _parse_url(url, encoding='utf-8'):
+    return whatwg_url.parse_url(url, encoding=encoding)
+
+
+def parse_url(url, encoding='utf-8'):
+    """Parse an absolute URL. Raises `whatwg_url.UrlParserError` on invalid URLs.
+
+    Parsing results are cached; each call returns a new `whatwg_url.Url` object that the caller may modify.
+    """
+    cached = _parse_url(url, encoding)
+
+    # Copying the components is much cheaper than parsing again
+    return whatwg_url.Url(
+        scheme=cached.scheme,
+        hostname=cached.hostname,
+        port=cached.port,
+        username=cached.username,
+        password=cached.password,
+        query=cached.query,
+        fragment=cached.fragment,
+        path=list(cached._path),  # pylint: disable=protected-access
+        cannot_be_base_url=cached.cannot_be_base_url,
+        encoding=cached.encoding,
+    )
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def resolve_url(href, base=None, encoding='utf-8'):
+    """Resolve a (possibly relative) URL against a base URL and return the serialized absolute URL.
+
+    Returns None if either URL cannot be parsed.
+    """
+    try:
+        base_url = _parse_url(base, encoding) if base is not None else None
+        return whatwg_url.parse_url(href, base=base_url, encoding=encoding).href
+    except whatwg_url.UrlParserError:
+        return None
+
+
+@functools.lru_cache(maxsize=1 << 20)
+def extract_domain(url):
+    """Split the hostname of a URL (or a bare hostname) into subdomain, domain and public suffix.
+
+    Returns a `tldextract.ExtractResult`, e.g., `registered_domain` is the registrable domain (eTLD+1).
+    """
+    return _tld_extractor(url)
+
+
+def cache_info():
+    """Hit statistics of the URL caches."""
+    return {
+        'parse_url': _parse_url.cache_info(),
+        'resolve_url': resolve_url.cache_info(),
+        'extract_domain': extract_domain.cache_info(),
+    }
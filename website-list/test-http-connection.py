@@ -7,12 +7,13 @@ from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlsplit
 
 import requests
-import tldextract
 import tqdm
 import urllib3
 
 sys.path.insert(0, os.path.join(sys.path[0], '..', 'pylib'))
-from langutil import check_html_language  # pylint: disable=wrong-import-position
+# pylint: disable=wrong-import-position
+from langutil import check_html_language
+from urlutil import extract_domain
 
 
 def test_domain(domain):
@@ -48,7 +49,7 @@ def test_domain(domain):
             'ip': ip,
             'url': init_url,
             'redirected_url': urlsplit(req.url, allow_fragments=False)._replace(query='').geturl(),
-            'domain_has_changed': tldextract.extract(req.url).registered_domain != domain,
+            'domain_has_changed': extract_domain(req.url).registered_domain != domain,
         })
 
         break